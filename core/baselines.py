@@ -7,7 +7,7 @@ import os, glob, zipfile, tarfile, fnmatch, shutil
 # pylint:disable=redefined-builtin
 from io import open
 
-from . import paths, update, log
+from . import paths, update, log, helpers
 from .lnp import lnp
 
 def find_vanilla(download_missing=True):
@@ -105,6 +105,10 @@ def simplify_pack(pack, folder):
     log.v('Removed {} files'.format(files_before - files_after))
     return files_before - files_after
 
+# Raws, DFHack init files and scripts; these are compared ignoring line
+# endings, other files (eg. sprite sheets) byte for byte
+_text_files = ('.txt', '.init', '.lua', '.rb')
+
 def remove_vanilla_raws_from_pack(pack, folder):
     """Remove files identical to vanilla raws, return files removed
 
@@ -130,14 +134,10 @@ def remove_vanilla_raws_from_pack(pack, folder):
                     os.remove(f)
                     continue
                 van_f = os.path.join(van_folder, os.path.relpath(f, folder))
-                if os.path.isfile(van_f):
-                    with open(van_f, encoding='cp437', errors='replace') as v:
-                        vtext = v.read()
-                    with open(f, encoding='cp437', errors='replace') as m:
-                        mtext = m.read()
-                    if vtext == mtext:
-                        os.remove(f)
-                        i += 1
+                if os.path.isfile(van_f) and helpers.files_equal(
+                        f, van_f, ignore_newlines=f.endswith(_text_files)):
+                    os.remove(f)
+                    i += 1
     return i
 
 def remove_empty_dirs(pack, folder):
@@ -40,7 +40,7 @@ def get_colors(colorscheme=None):
             else:
                 f = paths.get('init', 'colors.txt')
         color_fields = [(c+'_R', c+'_G', c+'_B') for c in _df_colors]
-        result = DFRaw(f).get_values(*color_fields)
+        result = DFRaw.peek_values(f, *color_fields)
         return [tuple(int(x) for x in t) for t in result]
     except:
         log.e('Unable to read current colors', stack=True)
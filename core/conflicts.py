@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Reports of overlapping changes between mods."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+
+from . import baselines, graphics, helpers, log, mods, paths
+from .mergesession import MergeSession, get_merge_session
+
+def conflict_report(list_of_mods, gfx=None):
+    """Reports where merging the specified mods would overwrite changes,
+    without writing any files.  Arguments are as for mods.merge_all_mods.  This
+    can be called while a MergeJob is running.
+
+    Yields:
+        A dict for each file changed by any mod, in order of path:
+            file
+                path of the file relative to the DF folder
+            mods
+                the mods (and graphics pack) changing the file, in order
+            conflicts
+                a list of dicts with 'start' and 'end' vanilla line numbers
+                (None for whole files) and the 'mods' whose changes to those
+                lines differ
+    """
+    # pylint:disable=too-many-locals
+    vanilla = baselines.find_vanilla(False)
+    if not vanilla:
+        log.e('Could not check mods: baseline unavailable')
+        return
+    if not gfx and mods.will_premerge_gfx():
+        gfx = graphics.current_pack()
+    sources = [('mods/' + mod, paths.get('mods', mod)) for mod in list_of_mods]
+    if gfx:
+        sources.insert(0, ('graphics/' + gfx, paths.get('graphics', gfx)))
+    changes = {}
+    for name, folder in sources:
+        for sub in ('raw', os.path.join('data', 'speech')):
+            for root, _, files in os.walk(os.path.join(folder, sub)):
+                for k in files:
+                    f = os.path.relpath(os.path.join(root, k), folder)
+                    changes.setdefault(f, []).append((name, os.path.join(
+                        root, k)))
+    # A merge may be running in the background, so use a session of our
+    # own, starting from the diffs of the shared one if it is not in use
+    session = MergeSession(vanilla)
+    if mods._merge_lock.acquire(False):
+        try:
+            shared = get_merge_session(vanilla)
+            for f in changes:
+                van_f = os.path.join(vanilla, f)
+                if f.endswith(('.txt', '.init')) and os.path.isfile(van_f):
+                    session.add_diffs(shared.cached_diffs(van_f))
+        finally:
+            mods._merge_lock.release()
+    for f in sorted(changes):
+        yield {'file': f, 'mods': [c[0] for c in changes[f]],
+               'conflicts': _file_conflicts(session, os.path.join(
+                   vanilla, f), changes[f])}
+
+def _file_conflicts(session, van_f, changes):
+    """Returns the conflicts for one file, as described for conflict_report.
+
+    Params:
+        session
+            the MergeSession used to read and diff files
+        van_f
+            path to the vanilla file
+        changes
+            a list of (mod, path) pairs of the versions merged into it
+    """
+    # pylint:disable=too-many-locals
+    if not any([van_f.endswith(a) for a in ('.txt', '.init')]) or (
+            not os.path.isfile(van_f)):
+        # Whole files are replaced, or (without vanilla) two-way merged
+        differ = [name for (name, path), (_, prev) in zip(
+            changes[1:], changes) if not helpers.files_equal(path, prev)]
+        if not differ:
+            return []
+        return [{'start': None, 'end': None, 'mods': [changes[0][0]] + differ}]
+    van_lines = session.read_lines(van_f)
+    earlier, found = [], []
+    for name, path in changes:
+        lines = session.read_lines(path)
+        hunks = [(op[1:], lines[op[3]:op[4]]) for op in session.diff(
+            van_lines, lines) if op[0] != 'equal']
+        for hunk, new in hunks:
+            for other, other_new, other_name in earlier:
+                if _hunks_touch(hunk, other) and (
+                        hunk[:2] != other[:2] or new != other_new):
+                    found.append([min(hunk[0], other[0]),
+                                  max(hunk[1], other[1]), [other_name, name]])
+        earlier.extend((hunk, new, name) for hunk, new in hunks)
+    conflicts = []
+    for start, end, names in sorted(found):
+        if conflicts and start <= conflicts[-1]['end']:
+            last = conflicts[-1]
+            last['end'] = max(last['end'], end)
+            last['mods'].extend(n for n in names if n not in last['mods'])
+        else:
+            conflicts.append({'start': start, 'end': end,
+                              'mods': list(names)})
+    return conflicts
+
+def _hunks_touch(a, b):
+    """Returns True if the hunks (i1, i2, j1, j2) change overlapping vanilla
+    lines, or if one inserts lines at the edge of the other."""
+    if a[0] < b[1] and b[0] < a[1]:
+        return True
+    return (a[0] == a[1] and b[0] <= a[0] <= b[1]) or (
+        b[0] == b[1] and a[0] <= b[0] <= a[1])
@@ -9,11 +9,10 @@ import zlib
 from datetime import datetime
 from distutils import dir_util
 from glob import glob
-from functools import total_ordering
 # pylint:disable=redefined-builtin
 from io import open
 
-from .settings import DFConfiguration
+from .settings import DFConfiguration, Version
 from . import hacks, paths, log
 from .lnp import lnp, VERSION
 
@@ -154,6 +153,7 @@ class DFInstall(object):
         self.df_dir = path
         self.init_dir = os.path.join(path, 'data', 'init')
         self.save_dir = os.path.join(path, 'data', 'save')
+        self._inventories = {}
         self.version, self.source = self.detect_version()
         self.variations = self.detect_variations()
         self.settings = DFConfiguration(path, self)
@@ -169,46 +169,24 @@ class DFInstall(object):
     def _detect_version_from_index():
         """The most reliable way to detect DF version is '<df>/data/index'.
 
-        Adapted from https://github.com/lethosor/dftext
+        The result is cached in the user configuration, keyed by the path,
+        size and modification time of the index file.
         """
-        def convert(func, string):
-            """Convert between string and bytes on Py3."""
-            if sys.version_info[0] == 2:
-                return string
-            return func(string, encoding='cp437')
-
-        def index_scramble(text):
-            """Unscrambles data from the index file."""
-            text = list(text)
-            for i, ch in enumerate(text):
-                ord_ch = (ord(ch) if sys.version_info[0] == 2 else ch)
-                text[i] = chr(255 - (i % 5) - ord_ch)
-            return convert(bytes, ''.join(text))
-
-        with open(paths.get('df', 'data', 'index'), 'rb') as f:
-            in_text = f.read()
-
-        decompressed = b''
-        while in_text:
-            chunk_length = struct.unpack(str('<L'), in_text[:4])[0]
-            end = chunk_length + 4
-            decompressed += zlib.decompress(in_text[4:end])
-            in_text = in_text[end:]
-
-        record_count = struct.unpack(str('<L'), decompressed[:4])[0]
-        decompressed = decompressed[4:]
-        for _ in range(record_count):
-            record_length, record_length_2 = \
-                    struct.unpack(str('<LH'), decompressed[:6])
-            decompressed = decompressed[6:]
-            if record_length != record_length_2:
-                raise ValueError('Record lengths do not match')
-            record = decompressed[:record_length]
-            decompressed = decompressed[record_length:]
-            record = convert(str, index_scramble(record)).strip()
-            # Check if version is in record of form "18~v0.40.24\r\n"
-            if re.search(r"\d+~v[\d.a-z]+", record) is not None:
-                return (Version(record.partition('v')[-1]), 'index')
+        index = os.path.abspath(paths.get('df', 'data', 'index'))
+        stat = os.stat(index)
+        cache = lnp.userconfig.get_dict('indexVersionCache')
+        cached = cache.get(index)
+        if (cached and cached['mtime'] == stat.st_mtime and
+                cached['size'] == stat.st_size):
+            return (Version(cached['version']), 'index')
+        version = read_index_version(index)
+        if version is not None:
+            cache[index] = {
+                'mtime': stat.st_mtime, 'size': stat.st_size,
+                'version': version}
+            lnp.userconfig['indexVersionCache'] = cache
+            lnp.userconfig.save_data()
+            return (Version(version), 'index')
 
     def _detect_version_from_notes(self):
         """Attempt to detect Dwarf Fortress version based on release notes."""
@@ -217,10 +195,18 @@ class DFInstall(object):
             m = re.search(r"Release notes for ([\d.a-z]+)", notes_text.read())
         return (Version(m.group(1)), 'release notes')
 
+    def _get_tag_inventory(self, filename):
+        """Returns the tag inventory (see DFConfiguration.read_tag_inventory)
+        for <filename> in the init folder, reading the file only once."""
+        if filename not in self._inventories:
+            self._inventories[filename] = DFConfiguration.read_tag_inventory(
+                os.path.join(self.init_dir, filename))
+        return self._inventories[filename]
+
     def _detect_version_from_init(self):
         """Attempt to detect Dwarf Fortress version from init file contents."""
-        init = os.path.join(self.init_dir, 'init.txt')
-        d_init = os.path.join(self.init_dir, 'd_init.txt')
+        init = 'init.txt'
+        d_init = 'd_init.txt'
         versions = [
             (d_init, 'GRAZE_COEFFICIENT', '0.40.13', {}),
             (d_init, 'POST_PREPARE_EMBARK_CONFIRMATION', '0.40.09', {}),
@@ -253,7 +239,8 @@ class DFInstall(object):
             (init, 'KEY_HOLD_MS', '0.21.101.19a', {}),
             (init, 'SOUND', '0.21.100.19a', {})]
         for v in versions:
-            if DFConfiguration.has_field(v[0], v[1], **v[3]):
+            if DFConfiguration.inventory_has_field(
+                    self._get_tag_inventory(v[0]), v[1], **v[3]):
                 log.w('DF version detected based on init analysis; unreliable')
                 return (Version(v[2]), 'init detection')
 
@@ -287,8 +274,9 @@ class DFInstall(object):
             if glob(os.path.join(
                     self.df_dir, 'hack', 'plugins', 'twbt.plug.*')):
                 result.append('twbt')
-        if self.version <= '0.31.12' or not DFConfiguration.has_field(
-                os.path.join(self.init_dir, 'init.txt'), 'PRINT_MODE'):
+        if (self.version <= '0.31.12' or
+                not DFConfiguration.inventory_has_field(
+                    self._get_tag_inventory('init.txt'), 'PRINT_MODE')):
             result.append('legacy')
         return result
 
@@ -310,42 +298,56 @@ class DFInstall(object):
             return base + '_s.zip'
         return base + '.zip'
 
-# pylint:disable=too-few-public-methods
-@total_ordering
-class Version(object):
-    """Container for a version number for easy comparisons."""
-    def __init__(self, version):
-        #Known errors in release notes
-        if version == "0.23.125.23a":
-            version = "0.23.130.23a"
-        self.version_str = version
-        s = ""
-        data = []
-        for c in version:
-            if c < '0' or c > '9':
-                data.append(int(s))
-                if c != '.':
-                    data.append(c)
-                s = ""
-            else:
-                s = s + c
-        if s != '':
-            data.append(int(s))
-        self.data = tuple(data)
-
-    def __lt__(self, other):
-        if not isinstance(self, Version):
-            return Version(self) < other
-        if not isinstance(other, Version):
-            return self < Version(other)
-        return self.data < other.data
+# Translation tables to unscramble index records; byte i of a record uses table
+# i % 5
+_index_tables = [
+    bytes(bytearray((255 - k - b) % 256 for b in range(256))) for k in range(5)]
 
-    def __eq__(self, other):
-        if not isinstance(self, Version):
-            return Version(self) == other
-        if not isinstance(other, Version):
-            return self == Version(other)
-        return self.data == other.data
+def read_index_version(path):
+    """Returns the DF version string stored in the index file at <path>, or
+    None if there is no version record. Chunks are only decompressed until the
+    version record has been found.
 
-    def __str__(self):
-        return self.version_str
+    Adapted from https://github.com/lethosor/dftext
+    """
+    with open(path, 'rb') as f:
+        stream = _IndexStream(f.read())
+    record_count = struct.unpack(str('<L'), stream.read(4))[0]
+    for _ in range(record_count):
+        record_length, record_length_2 = struct.unpack(
+            str('<LH'), stream.read(6))
+        if record_length != record_length_2:
+            raise ValueError('Record lengths do not match')
+        record = bytearray(stream.read(record_length))
+        for k, table in enumerate(_index_tables):
+            record[k::5] = record[k::5].translate(table)
+        record = record.decode('cp437').strip()
+        # Check if version is in record of form "18~v0.40.24\r\n"
+        if re.search(r"\d+~v[\d.a-z]+", record) is not None:
+            return record.partition('v')[-1]
+    return None
+
+class _IndexStream(object):
+    """Reads the decompressed contents of a DF index file on demand."""
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def read(self, length):
+        """Returns the next <length> decompressed bytes."""
+        while len(self.buffer) - self.offset < length:
+            if self.pos >= len(self.data):
+                raise ValueError('Unexpected end of index file')
+            # Drop consumed data before appending the next chunk
+            del self.buffer[:self.offset]
+            self.offset = 0
+            chunk_length = struct.unpack_from(
+                str('<L'), self.data, self.pos)[0]
+            start = self.pos + 4
+            self.pos = start + chunk_length
+            self.buffer += zlib.decompress(self.data[start:self.pos])
+        result = self.buffer[self.offset:self.offset + length]
+        self.offset += length
+        return bytes(result)
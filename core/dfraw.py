@@ -6,18 +6,31 @@ import io
 import re
 import sys
 import os
+from collections import OrderedDict
 from fnmatch import fnmatch
+from threading import Lock
 
 from . import log
 
 if sys.version_info[0] == 3:
     #pylint: disable=redefined-builtin
     basestring = str
+    _intern = sys.intern
+else:
+    # Python 2 can only intern byte strings; share equal names via a dict
+    _interned_names = {}
+    def _intern(name):
+        """Returns a shared instance of the string <name>."""
+        return _interned_names.setdefault(name, name)
 
 NODE_COMMENT = 1 << 1
 NODE_TAG = 1 << 2
 NODE_ROOT = 1 << 3
 
+# Shared (immutable) child list for nodes without children; replaced by a real
+# list when the first child is added
+_no_children = ()
+
 # These are glob patterns - * represents an arbitrary string
 object_parents = {
     'BODY': ['BODY'],
@@ -51,6 +64,9 @@ init_filename_parents = {
 # Do not allow parent tags to go under these tags
 final_level_tags = ['TILE_PAGE']
 
+# Tags, flags and (as a fallback) unterminated tags, in order of precedence
+_raw_token_re = re.compile(r'\[[^\]]*\]|!\w+!|\[')
+
 def tokenize_raw(text):
     """Generator which returns nodes from a raw file.
 
@@ -63,35 +79,36 @@ def tokenize_raw(text):
                 "Tag" or "Comment"
             token
                 Token text (including any delimiters)"""
-    while text:
-        curr_string = ''
-        if text[0] == '[':
-            if ']' not in text:
-                raise Exception('Found non-terminated tag: '+text[0:100])
-            curr_string = text[:text.find(']')+1]
-            node_type = 'Tag'
-        if text[0] == '!':
-            match = re.match('!\\w+!', text)
-            if match:
-                curr_string = match.group()
-                node_type = 'Tag'
-        if not curr_string:
-            if '[' in text:
-                curr_string = text[:text.find('[')]
-            else:
-                curr_string = text
-            #check for
-            match = re.search('!\\w+!', text)
-            if match:
-                curr_string = curr_string[:match.start()]
-            node_type = 'Comment'
-        text = text[len(curr_string):]
-        yield node_type, curr_string
-
+    pos = 0
+    for match in _raw_token_re.finditer(text):
+        start = match.start()
+        if start > pos:
+            yield 'Comment', text[pos:start]
+        token = match.group()
+        if token == '[':
+            raise Exception('Found non-terminated tag: '+text[start:start+100])
+        yield 'Tag', token
+        pos = match.end()
+    if pos < len(text):
+        yield 'Comment', text[pos:]
+
+
+def split_tag(token):
+    """Splits a tag token into its name and value. Flags have the value True
+    if written as [FLAG], or False if disabled as !FLAG!."""
+    contents = token[1:-1]
+    if ':' in contents:
+        return contents.split(':', 1)
+    return contents, token[0] == '['
 
 def parse_raw(parent, text):
     """Parses the raw text contained in <text> and places resulting nodes in a
     tree under <parent>."""
+    parse_tokens(parent, tokenize_raw(text))
+
+def parse_tokens(parent, tokens):
+    """Places nodes for the (kind, token) pairs in <tokens>, as produced by
+    tokenize_raw, in a tree under <parent>."""
     path, fname = os.path.split(os.path.abspath(parent.filename))
     path = path.split(os.sep)
     parent_tags = []
@@ -99,13 +116,9 @@ def parse_raw(parent, text):
     # Parent tags for raw/{graphics, objects} are handled later
     if path[-1] == 'init':
         parent_tags = init_filename_parents.get(fname, [])
-    for kind, token in tokenize_raw(text):
+    for kind, token in tokens:
         if kind == 'Tag':
-            contents = token[1:-1]
-            if ':' in contents:
-                name, value = contents.split(':', 1)
-            else:
-                name, value = contents, token[0] == '['
+            name, value = split_tag(token)
             is_parent = False
             for g in parent_tags:
                 if fnmatch(name, g):
@@ -124,8 +137,80 @@ def parse_raw(parent, text):
             log.e('Unknown raw token while parsing: '+kind)
             raise Exception('Unknown raw token kind: '+kind)
 
+class RawCache(object):
+    """Process-wide LRU cache of raw file contents and their tokens.
+
+    Entries are keyed by absolute path, and are re-read when the inode,
+    modification time, change time or size of the file changes. Files written
+    through DFRaw are dropped from the cache immediately."""
+    def __init__(self, max_entries=64):
+        """Constructor for RawCache.
+
+        Params:
+            max_entries
+                Number of files to keep; the least recently used file is
+                evicted when this is exceeded."""
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def __get_entry(self, path):
+        """Returns the up-to-date entry [identity, text, tokens] for <path>,
+        reading the file if needed. As in helpers.files_equal, a file is
+        taken as unchanged while its inode, mtime, ctime and size are."""
+        path = os.path.abspath(path)
+        with self.__lock:
+            try:
+                stat = os.stat(path)
+                identity = (stat.st_ino, stat.st_mtime, stat.st_ctime,
+                            stat.st_size)
+            except OSError:
+                identity = None # Let opening the file raise the error
+            entry = self.__entries.pop(path, None)
+            if entry is not None and identity is not None and (
+                    entry[0] == identity):
+                self.hits += 1
+            else:
+                self.misses += 1
+                with DFRaw.open(path, 'rt') as fd:
+                    entry = [identity, fd.read(), None]
+            self.__entries[path] = entry
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+            return entry
+
+    def get_text(self, path):
+        """Returns the contents of the raw file at <path>."""
+        return self.__get_entry(path)[1]
+
+    def get_tokens(self, path):
+        """Returns a tuple of the (kind, token) pairs in the raw file at
+        <path>. See tokenize_raw."""
+        entry = self.__get_entry(path)
+        if entry[2] is None:
+            entry[2] = tuple(tokenize_raw(entry[1]))
+        return entry[2]
+
+    def discard(self, path):
+        """Removes <path> from the cache, if present."""
+        with self.__lock:
+            self.__entries.pop(os.path.abspath(path), None)
+
+    def clear(self):
+        """Removes all files from the cache and resets the counters."""
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+parse_cache = RawCache()
+
 class DFRawNode(object):
     """Class representing a node in a raw file."""
+    __slots__ = ('name', 'children', '__parent', '__type', '__value')
+
     def __init__(self, parent, node_id, value, node_type, **kwargs):
         """Constructor for DFRawNode.
 
@@ -145,7 +230,7 @@ class DFRawNode(object):
                 is inserted after the child node provided in this argument.
                 If omitted, or if the provided child node does not exist, the
                 child is added as the last child."""
-        self.name = node_id
+        self.name = _intern(node_id)
         self.__parent = None
         self.__type = node_type
         if self.is_tag:
@@ -155,7 +240,7 @@ class DFRawNode(object):
                 self.__value = None
         else:
             self.__value = value
-        self.children = []
+        self.children = _no_children
         if parent:
             parent.add_child(self, **kwargs)
 
@@ -174,30 +259,34 @@ class DFRawNode(object):
                 is inserted after the child node provided in this argument.
                 If omitted, or if the provided child node does not exist, the
                 child is added as the last child."""
+        # pylint: disable=protected-access
         if child.is_root:
             return
+        if child.__parent is not None:
+            child.__parent.remove_child(child)
+        if self.children is _no_children:
+            self.children = []
+        position = len(self.children)
         if 'after' in kwargs:
-            if kwargs['after'] is not None:
-                try:
-                    self.children.insert(
-                        self.children.index(kwargs['after']), child)
-                    return
-                except ValueError:
-                    self.children.append(child)
-            else:
-                self.children.insert(0, child)
-        self.children.append(child)
-        if child.parent is not self and child.parent is not None:
-            child.parent.remove_child(child)
-        # pylint: disable=protected-access
+            if kwargs['after'] is None:
+                position = 0
+            elif kwargs['after'] in self.children:
+                position = self.children.index(kwargs['after']) + 1
+        self.children.insert(position, child)
         child.__parent = self
+        root = self.root
+        if root is not None:
+            root._index_add(child)
 
     def remove_child(self, child):
         """Removes <child> as a child node and sets its parent to None."""
-        if self.is_root:
+        # pylint: disable=protected-access
+        if child.is_root:
             return
+        root = self.root
+        if root is not None:
+            root._index_remove(child)
         self.children.remove(child)
-        # pylint: disable=protected-access
         child.__parent = None
 
     @property
@@ -232,8 +321,15 @@ class DFRawNode(object):
 
     @property
     def root(self):
-        """Returns the root node."""
-        return self if self.is_root else self.__parent.root
+        """Returns the root node, or None if this node is not part of a raw
+        file."""
+        node = self
+        while not node.is_root:
+            # pylint: disable=protected-access
+            node = node.__parent
+            if node is None:
+                return None
+        return node
 
     @property
     def filename(self):
@@ -272,34 +368,39 @@ class DFRawNode(object):
     @property
     def text(self):
         """Returns the text for this node."""
-        if self.is_root:
+        # Checks type bits directly; this is called for every node on save
+        node_type, value = self.__type, self.__value
+        if node_type & NODE_ROOT:
             return ''
-        elif self.is_comment:
-            return self.__value
-        elif self.is_flag:
-            if self.__value:
+        elif node_type & NODE_COMMENT:
+            return value
+        elif isinstance(value, bool):
+            if value:
                 return '[{0}]'.format(self.name)
             else:
                 return '!{0}!'.format(self.name)
         else:
-            return '[{0}:{1}]'.format(self.name, self.value)
+            return '[{0}:{1}]'.format(self.name, value)
 
     @property
     def fulltext(self):
         """Returns the text for this node and all its children."""
-        child_contents = ''
-        for c in self.children:
-            child_contents += c.fulltext
-        return self.text + child_contents
+        return self.text + ''.join([c.text for c in self.elements])
 
     @property
     def elements(self):
         """Generator producing a flat view of this node and its subnodes.
         Yields raw nodes."""
-        for c in self.children:
-            yield c
-            for c2 in c.elements:
-                yield c2
+        # Stack of iterators over the children of each level being visited
+        stack = [iter(self.children)]
+        while stack:
+            for c in stack[-1]:
+                yield c
+                if c.children:
+                    stack.append(iter(c.children))
+                    break
+            else:
+                stack.pop()
 
     def __str__(self):
         return self.text
@@ -307,25 +408,19 @@ class DFRawNode(object):
     def find_first(self, field):
         """Returns the first child node with the tag name field, or None if no
         such node exists."""
-        for c in self.children:
+        for c in self.elements:
             if c.name == field:
                 return c
-            child_result = c.find_first(field)
-            if child_result is not None:
-                return child_result
         return None
 
     def find_all(self, field):
         """Returns a list of all child nodes with the tag name field."""
-        result = []
-        for c in self.children:
-            if c.name == field:
-                result.append(c)
-            result += c.find_all(field)
-        return result
+        return [c for c in self.elements if c.name == field]
 
 class DFRaw(DFRawNode):
     """Represents a Dwarf Fortress raw file."""
+    __slots__ = ('_modified', '_index')
+
     def __init__(self, path):
         """Constructor for DFRaw.
 
@@ -334,6 +429,8 @@ class DFRaw(DFRawNode):
                 Path to the raw file that should be parsed."""
         super(DFRaw, self).__init__(None, '*ROOT*', path, NODE_ROOT)
         self._modified = False
+        # Maps tag names to nodes in document order; built on first lookup
+        self._index = None
         self.__parse()
 
     def __enter__(self):
@@ -354,13 +451,14 @@ class DFRaw(DFRawNode):
             mode
                 File mode (see io.open), typically 'rt' or 'wt'
         """
+        if 'r' not in mode or '+' in mode:
+            parse_cache.discard(path)
         return io.open(path, mode, encoding='cp437', errors='replace')
 
-    @classmethod
-    def read(cls, path):
+    @staticmethod
+    def read(path):
         """Returns the contents of the raw file at <path>."""
-        with cls.open(path, 'rt') as fd:
-            return fd.read()
+        return parse_cache.get_text(path)
 
     @classmethod
     def write(cls, path, text):
@@ -370,9 +468,7 @@ class DFRaw(DFRawNode):
 
     def save(self):
         """Re-writes the current raw file, saving all changes."""
-        with self.open(self.filename, 'wt') as fd:
-            for node in self.elements:
-                fd.write(node.text)
+        self.write(self.filename, self.fulltext)
 
     def __parse(self):
         """Parses a raw file into tokens and builds an appropriate hierarchy
@@ -384,7 +480,53 @@ class DFRaw(DFRawNode):
         #   interface.txt: [BIND] is parent (legacy will be flat)
         #   world_gen.txt: [WORLD_GEN] is parent
         # Non-raw files (unsupported): init/arena.txt, subdirs of raw/objects
-        parse_raw(self, self.read(self.filename))
+        parse_tokens(self, parse_cache.get_tokens(self.filename))
+
+    def _get_index(self):
+        """Returns the name index for this file, building it if needed."""
+        if self._index is None:
+            index = {}
+            for node in self.elements:
+                index.setdefault(node.name, []).append(node)
+            self._index = index
+        return self._index
+
+    def _index_add(self, node):
+        """Updates the name index after <node> was added to the tree. Nodes
+        appended at the end of the file are indexed directly; anything else
+        discards the index, to be rebuilt on the next lookup."""
+        if self._index is None:
+            return
+        n = node
+        while n is not self:
+            if n.parent.children[-1] is not n:
+                self._index = None
+                return
+            n = n.parent
+        for n in [node] + list(node.elements):
+            self._index.setdefault(n.name, []).append(n)
+
+    def _index_remove(self, node):
+        """Updates the name index before <node> is removed from the tree."""
+        if self._index is None:
+            return
+        for n in [node] + list(node.elements):
+            nodes = self._index[n.name]
+            nodes.remove(n)
+            if not nodes:
+                del self._index[n.name]
+
+    def find_first(self, field):
+        """Returns the first node with the tag name field, or None if no such
+        node exists."""
+        nodes = self._get_index().get(field)
+        if nodes:
+            return nodes[0]
+        return None
+
+    def find_all(self, field):
+        """Returns a list of all nodes with the tag name field."""
+        return list(self._get_index().get(field, ()))
 
     def set_all(self, field, value):
         """Sets all tags named <field> to <value>."""
@@ -420,8 +562,51 @@ class DFRaw(DFRawNode):
                 result.append(None)
         return result
 
+    @staticmethod
+    def peek_values(path, *fields):
+        """Returns the values of <fields> in the raw file at <path>, in the
+        same form as get_values, without building a tree for the file. The
+        file is only scanned until every field has been found."""
+        def wanted_names(fields):
+            """Yields all field names in <fields>, including nested ones."""
+            for field in fields:
+                if isinstance(field, (str, basestring)):
+                    yield field
+                elif isinstance(field, (tuple, list)):
+                    for f in wanted_names(field):
+                        yield f
+
+        def build_result(fields):
+            """Arranges found values to match the nesting of <fields>."""
+            result = []
+            for field in fields:
+                if isinstance(field, (str, basestring)):
+                    result.append(found.get(field))
+                elif isinstance(field, (tuple, list)):
+                    result.append(build_result(field))
+                else:
+                    result.append(None)
+            return result
+
+        wanted = set(wanted_names(fields))
+        found = {}
+        if wanted:
+            # Tokenized lazily, so that the scan can stop early
+            for kind, token in tokenize_raw(parse_cache.get_text(path)):
+                if kind != 'Tag':
+                    continue
+                name, value = split_tag(token)
+                if name in wanted and name not in found:
+                    # Empty values are stored as None, matching DFRawNode
+                    found[name] = value or None
+                    if len(found) == len(wanted):
+                        break
+        return build_result(fields)
+
 class DFRawTag(DFRawNode):
     """Represents a tag in a raw file."""
+    __slots__ = ()
+
     def __init__(self, parent, tag, value):
         """Constructor for DFRawTag.
 
@@ -436,6 +621,8 @@ class DFRawTag(DFRawNode):
 
 class DFRawComment(DFRawNode):
     """Represents a comment (non-tag) in a raw file."""
+    __slots__ = ()
+
     def __init__(self, parent, text):
         """Constructor for DFRawComment.
 
@@ -3,7 +3,8 @@
 """Graphics pack management."""
 from __future__ import print_function, unicode_literals, absolute_import
 
-import os, shutil, glob
+import os, shutil, glob, time
+from collections import OrderedDict
 from .launcher import open_file
 from .lnp import lnp
 from . import colors, df, paths, baselines, mods, log, manifest
@@ -74,7 +75,8 @@ def read_graphics():
             continue
         init_path = paths.get('graphics', p, 'data', 'init', 'init.txt')
         #pylint: disable=unbalanced-tuple-unpacking
-        font, graphics = DFRaw(init_path).get_values('FONT', 'GRAPHICS_FONT')
+        font, graphics = DFRaw.peek_values(
+            init_path, 'FONT', 'GRAPHICS_FONT')
         result.append((p, font, graphics))
     return tuple(sorted(result))
 
@@ -278,6 +280,17 @@ def update_graphics_raws(raw_dir, pack):
         True if successful
         False if aborted
     """
+    times = _update_graphics_raws([raw_dir], pack)
+    return times if times is None else bool(times)
+
+def _update_graphics_raws(raw_dirs, pack):
+    """Updates raw dirs built from the same mods in place for a new graphics
+    pack (see update_graphics_raws).
+
+    Returns:
+        An OrderedDict of the seconds taken to update each dir if successful,
+        False if aborted, or None if the pack cannot be used.
+    """
     if not validate_pack(pack):
         log.w('Cannot update raws to an invalid graphics pack (' + pack + ')')
         return None
@@ -287,21 +300,43 @@ def update_graphics_raws(raw_dir, pack):
         log.w('Save raws not compatible with ' + pack + ' graphics, aborting.')
         return None
     built_graphics = logged_graphics(built_log)
-    if mods.update_raw_dir(raw_dir, gfx=(pack, built_graphics)):
-        log.i('Safely updated graphics raws ' + raw_dir + ' to ' + pack)
-        return True
-    log.i('Aborted while updating raws ' + raw_dir + ' to ' + pack)
+    times = mods.update_raw_dirs(raw_dirs, gfx=(pack, built_graphics))
+    if times is not None:
+        for raw_dir, seconds in times.items():
+            log.i('Safely updated graphics raws {} to {} ({:.2f}s)'.format(
+                raw_dir, pack, seconds))
+        return times
+    for raw_dir in raw_dirs:
+        log.i('Aborted while updating raws ' + raw_dir + ' to ' + pack)
     return False
 
 def update_savegames():
-    """Update save games with current raws."""
-    count, skipped, saves = 0, 0, savegames_to_update()
-    for save_raws in [paths.get('saves', s, 'raw') for s in saves]:
-        r = can_rebuild(os.path.join(save_raws, 'installed_raws.txt'))
-        if r and update_graphics_raws(save_raws, current_pack()):
-            count += 1
+    """Update save games with current raws.
+
+    Saves built from the same mods are updated together, so each distinct
+    merge is only built once.  The time taken for each save is logged.
+
+    Returns:
+        A tuple (updated saves, skipped saves).
+    """
+    count, skipped, pack = 0, 0, current_pack()
+    groups = OrderedDict()
+    for save_raws in [paths.get('saves', s, 'raw')
+                      for s in savegames_to_update()]:
+        log_file = os.path.join(save_raws, 'installed_raws.txt')
+        if can_rebuild(log_file):
+            groups.setdefault(tuple(mods.read_installation_log(log_file)),
+                              []).append(save_raws)
         else:
             skipped += 1
+    for mods_list, raw_dirs in groups.items():
+        start = time.time()
+        if _update_graphics_raws(raw_dirs, pack):
+            count += len(raw_dirs)
+            log.i('Updated {} savegame(s) with mods [{}] in {:.2f}s'.format(
+                len(raw_dirs), ', '.join(mods_list), time.time() - start))
+        else:
+            skipped += len(raw_dirs)
     return count, skipped
 
 def can_rebuild(log_file, strict=True):
@@ -3,7 +3,7 @@
 """Helper functions."""
 from __future__ import print_function, unicode_literals, absolute_import
 
-import sys, os, glob, platform
+import sys, os, glob, platform, hashlib
 
 from .dfraw import DFRaw
 from . import log
@@ -24,6 +24,60 @@ def get_text_files(directory):
             result.append(f)
     return result
 
+_file_hashes = {}
+
+def files_equal(a, b, ignore_newlines=False):
+    """Returns True if the files <a> and <b> have the same contents.
+
+    Sizes are compared first, then contents in chunks.  Hashes of files read
+    to the end are cached, so unchanged files are not read again.  A file is
+    taken as unchanged while its inode, size, mtime and ctime are; files
+    copied with their mtime still differ in inode or ctime.
+
+    Params:
+        a, b
+            The paths of the files to compare.
+        ignore_newlines
+            If True, '\\r\\n', '\\r' and '\\n' compare as equal, as in files
+            opened in text mode.
+    """
+    try:
+        stats = [os.stat(a), os.stat(b)]
+    except OSError:
+        return False
+    if not ignore_newlines and stats[0].st_size != stats[1].st_size:
+        return False
+    keys = [(f, ignore_newlines) for f in (a, b)]
+    idents = [(st.st_ino, st.st_mtime, st.st_ctime, st.st_size)
+              for st in stats]
+    hashes = [_file_hashes.get(k, (None, None)) for k in keys]
+    if all(h[0] == i for h, i in zip(hashes, idents)):
+        return hashes[0][1] == hashes[1][1]
+    if len(_file_hashes) > 4096:
+        _file_hashes.clear()
+    if ignore_newlines:
+        digests = []
+        for f in (a, b):
+            with open(f, 'rb') as fh:
+                data = fh.read()
+            digests.append(hashlib.sha1(data.replace(b'\r\n', b'\n').replace(
+                b'\r', b'\n')).digest())
+    else:
+        digests = [hashlib.sha1(), hashlib.sha1()]
+        with open(a, 'rb') as fa, open(b, 'rb') as fb:
+            while True:
+                chunk_a, chunk_b = fa.read(65536), fb.read(65536)
+                if chunk_a != chunk_b:
+                    return False
+                if not chunk_a:
+                    break
+                digests[0].update(chunk_a)
+                digests[1].update(chunk_b)
+        digests = [d.digest() for d in digests]
+    for k, i, d in zip(keys, idents, digests):
+        _file_hashes[k] = (i, d)
+    return digests[0] == digests[1]
+
 def detect_installed_file(current_file, test_files):
     """Returns the file in <test_files> which is contained in
     <current_file>, or "Unknown"."""
@@ -3,7 +3,7 @@
 """Logging module."""
 from __future__ import print_function, unicode_literals, absolute_import
 
-import sys, traceback
+import sys, threading, traceback
 
 _log = None
 
@@ -23,7 +23,22 @@ class Log(object):
         self.output_out = False
         self.level_stack = []
         self.lines = []
-        self.prefixes = []
+        self.__local = threading.local()
+
+    @property
+    def prefixes(self):
+        """The prefixes of messages logged by the current thread.  Each
+        thread has its own, so that eg. a background merge does not prefix
+        messages logged by the GUI."""
+        try:
+            return self.__local.prefixes
+        except AttributeError:
+            self.__local.prefixes = []
+            return self.__local.prefixes
+
+    @prefixes.setter
+    def prefixes(self, value):
+        self.__local.prefixes = value
 
     def push_level(self, level):
         """Temporarily changes the logging level to <level>. Call pop_level to
@@ -44,8 +59,8 @@ class Log(object):
         self.max_level = level
 
     def push_prefix(self, prefix):
-        """Adds a prefix to future log messages. Old prefixes will appear before
-        new prefixes."""
+        """Adds a prefix to future log messages from the current thread. Old
+        prefixes will appear before new prefixes."""
         self.prefixes.append(prefix)
 
     def pop_prefix(self):
@@ -116,6 +131,12 @@ class Log(object):
         """Writes a WARNING message to the log. See Log.log for details."""
         return self.log(WARNING, message, *args, **kwargs)
 
+    def extend(self, lines):
+        """Writes lines that were already formatted by another Log instance,
+        eg one in a worker process."""
+        for l in lines:
+            self.__write(l)
+
     def get_lines(self):
         """Returns all logged lines."""
         return self.lines
@@ -148,6 +169,7 @@ error = e = _log.e
 info = i = _log.i
 verbose = v = _log.v
 warning = w = _log.w
+extend = _log.extend
 get_lines = _log.get_lines
 push_prefix = _log.push_prefix
 pop_prefix = _log.pop_prefix
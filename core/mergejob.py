@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Merging mods in a background thread."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+from threading import Event, Lock, Thread
+
+from . import log, mods, paths
+
+_job_lock = Lock()
+_current_job = None
+
+# The job's own state, and the progress it reports to the GUI
+# pylint:disable=too-many-instance-attributes
+class MergeJob(object):
+    """Runs mods.merge_all_mods in a background thread.  Starting a job cancels
+    the previous one, and waits for it to stop before merging."""
+    def __init__(self, list_of_mods, gfx=None, mode=None):
+        """Constructor for MergeJob.  Arguments are as for merge_all_mods;
+        register callbacks before calling start."""
+        self.list_of_mods = list(list_of_mods)
+        self.gfx = gfx
+        self.mode = mode
+        self.on_progress = []
+        self.on_end = []
+        # Progress through the mod being merged; mods restored from
+        # checkpoints or the merge cache are not reported
+        self.current_mod = None
+        self.files_done = 0
+        self.files_total = 0
+        self.__cancelled = False
+        self.__finished = Event()
+        self.__result = None
+        self.__error = None
+
+    def register_progress(self, func):
+        """Registers a function func(job, mod, filename) to be called from the
+        merge thread after each file is merged; see current_mod, files_done
+        and files_total."""
+        self.on_progress.append(func)
+
+    def register_end(self, func):
+        """Registers a function func(job) to be called from the merge thread
+        when the job ends, even if it was cancelled or failed."""
+        self.on_end.append(func)
+
+    def start(self):
+        """Starts the job in a new thread, and returns it."""
+        # pylint:disable=global-statement
+        global _current_job
+        with _job_lock:
+            previous, _current_job = _current_job, self
+        if previous is not None:
+            previous.cancel()
+        t = Thread(target=self.__run, args=(previous,))
+        t.daemon = True
+        t.start()
+        return self
+
+    def cancel(self):
+        """Asks the job to stop at the next file; see merge_all_mods."""
+        self.__cancelled = True
+
+    def cancelled(self):
+        """Returns True if the job was asked to stop."""
+        return self.__cancelled
+
+    def done(self):
+        """Returns True if the job has ended."""
+        return self.__finished.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the job to end, and returns the list of statuses from
+        merge_all_mods.  Re-raises any exception raised by the merge.
+        Returns None if the job is still running after <timeout> seconds."""
+        if not self.__finished.wait(timeout):
+            return None
+        if self.__error is not None:
+            raise self.__error # pylint:disable=raising-bad-type
+        return self.__result
+
+    def __run(self, previous):
+        """Merges the mods after the previous job (if any) has ended."""
+        # pylint:disable=broad-except
+        if previous is not None:
+            try:
+                previous.result()
+            except Exception:
+                pass # Already logged by that job
+        try:
+            self.__result = mods.merge_all_mods(
+                self.list_of_mods, self.gfx, self.mode, self.__progress,
+                self.cancelled)
+        except Exception as ex:
+            log.e('Background merge failed', stack=True)
+            self.__error = ex
+        self.__finished.set()
+        for func in self.on_end:
+            try:
+                func(self)
+            except Exception:
+                log.e('Merge end callback failed', stack=True)
+
+    def __progress(self, mod, filename):
+        """Counts a merged file and calls the progress callbacks."""
+        if mod != self.current_mod:
+            self.current_mod, self.files_done, self.files_total = mod, 0, 0
+            for sub in ('raw', os.path.join('data', 'speech')):
+                self.files_total += sum(len(f) for _, _, f in os.walk(
+                    paths.get('mods', mod, sub)))
+        self.files_done += 1
+        for func in self.on_progress:
+            func(self, mod, filename)
+
+def cancel_merge_job():
+    """Cancels the running MergeJob, if any, and waits for it to end."""
+    with _job_lock:
+        job = _current_job
+    if job is not None:
+        job.cancel()
+        # pylint:disable=broad-except
+        try:
+            job.result()
+        except Exception:
+            pass # Already logged by the job
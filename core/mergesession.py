@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""State kept between merges: the MergeSession and the merge cache."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os, shutil, glob, time, hashlib, json
+from collections import OrderedDict
+# pylint:disable=redefined-builtin
+from io import open
+
+from . import paths, log, rawdiff
+from .lnp import lnp
+from .treesync import link_tree
+
+def get_diff_backend():
+    """Returns the name of the diff backend used for merging; either
+    'patience' (default) or 'difflib'."""
+    backend = lnp.userconfig.get_string('merge_diff_backend')
+    if backend in rawdiff.backends:
+        return backend
+    return 'patience'
+
+def set_diff_backend(backend):
+    """Sets the diff backend used for merging (see get_diff_backend)."""
+    lnp.userconfig['merge_diff_backend'] = backend
+    lnp.userconfig.save_data()
+
+def file_identity(st):
+    """Returns a value that changes whenever the file with the stat result
+    <st> changes.  As in helpers.files_equal, this includes the inode and
+    ctime, as files copied with their mtime kept still differ in those."""
+    return (st.st_ino, st.st_mtime, st.st_ctime, st.st_size)
+
+def folder_signature(path):
+    """Returns a value that changes whenever files in the folder change."""
+    result = []
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                st = os.stat(os.path.join(root, f))
+            except OSError:
+                continue
+            result.append((os.path.join(root, f), file_identity(st)))
+    return tuple(sorted(result))
+
+# Besides its caches, the session carries the options and callbacks of the
+# running merge, so that they need not be passed through every merge function
+# pylint:disable=too-many-instance-attributes
+class MergeSession(object):
+    """Caches what stays valid between merges against one baseline: the
+    lines of vanilla files, and the diffs from vanilla to each merged or mod
+    text seen so far.  Diffs are keyed by content hashes, so they are reused
+    across mods and across repeated merges of the same mod list."""
+    max_diffs = 512
+
+    def __init__(self, baseline):
+        self.baseline = baseline
+        self.backend = None
+        self.mode = None
+        # Per-file timings while profiling (see mods.export_profile), and the
+        # time and changed hunks of diffs for the file being merged
+        self.profile = None
+        self.diff_time = 0
+        self.hunks = 0
+        # Callbacks and process pool of the running merge (see
+        # mods.merge_all_mods and mods._MergePool)
+        self.current_mod = None
+        self.progress = None
+        self.cancelled = None
+        self.use_pool = False
+        self.executor = None
+        self.hits = 0
+        self.misses = 0
+        self._lines = {}
+        self._hashes = {}
+        self._diffs = OrderedDict()
+        # Checkpoints of the merge in LNP/Baselines/temp: the graphics pack
+        # and merge mode, then (mod, signature, status, undo) for each mod.
+        # Undo logs map each file written to a snapshot of its previous
+        # contents in LNP/Baselines/merge_undo (or None if it was not a file).
+        self._setup = None
+        self._checkpoints = None
+        self._undo = None
+        self._steps = 0
+
+    def start(self, setup):
+        """Starts recording checkpoints for a merge freshly set up in
+        LNP/Baselines/temp, with the given (graphics pack, merge mode)."""
+        self._clear_snapshots()
+        self._setup = setup
+        self._checkpoints = []
+        self._undo = None
+
+    def restore(self, setup, mods, statuses):
+        """Marks LNP/Baselines/temp as holding a merge of <mods> restored
+        from elsewhere, with the given (graphics pack, merge mode).  More mods
+        can be merged on top, but the restored mods cannot be rolled back."""
+        self._clear_snapshots()
+        self._setup = setup
+        self._checkpoints = [(mod, signature, status, None) for (
+            mod, signature), status in zip(mods, statuses)]
+        self._undo = None
+
+    def folder_hash(self, path):
+        """Returns a hash of the names and contents of the files in a folder,
+        re-reading the files only if the folder changed."""
+        signature = folder_signature(path)
+        cached = self._hashes.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        h = hashlib.sha1()
+        for filename, _ in signature:
+            h.update(os.path.relpath(filename, path).encode('utf-8'))
+            with open(filename, 'rb') as f:
+                h.update(f.read())
+        self._hashes[path] = (signature, h.hexdigest())
+        return self._hashes[path][1]
+
+    def is_cancelled(self):
+        """Returns True if the running merge should stop."""
+        return self.cancelled is not None and bool(self.cancelled())
+
+    def invalidate(self):
+        """Discards all checkpoints, eg because the temp folder was reset."""
+        self._clear_snapshots()
+        self._checkpoints = None
+        self._undo = None
+
+    @staticmethod
+    def _clear_snapshots():
+        """Deletes the snapshots of all undo logs."""
+        if os.path.isdir(paths.get('baselines', 'merge_undo')):
+            shutil.rmtree(paths.get('baselines', 'merge_undo'))
+
+    def begin_step(self):
+        """Starts recording the files changed by merging a mod."""
+        self._steps += 1
+        self._undo = OrderedDict()
+
+    def end_step(self, mod, signature, status):
+        """Finishes merging a mod, adding a checkpoint after it."""
+        if self._checkpoints is not None and self._undo is not None:
+            self._checkpoints.append((mod, signature, status, self._undo))
+        self._undo = None
+
+    def record(self, filename):
+        """Saves the contents of a file before a merge step changes it.  The
+        file is hardlinked into LNP/Baselines/merge_undo where possible, as
+        files in LNP/Baselines/temp are replaced rather than written to
+        (see treesync.break_link)."""
+        if self._undo is None or filename in self._undo:
+            return
+        if not os.path.isfile(filename):
+            self._undo[filename] = None
+            return
+        snapshot = paths.get('baselines', 'merge_undo', str(self._steps),
+                             str(len(self._undo)))
+        if not os.path.isdir(os.path.dirname(snapshot)):
+            os.makedirs(os.path.dirname(snapshot))
+        try:
+            os.link(filename, snapshot)
+        except (AttributeError, OSError):
+            shutil.copy2(filename, snapshot)
+        self._undo[filename] = snapshot
+
+    def resume(self, setup, mods):
+        """Rolls LNP/Baselines/temp back to the last checkpoint shared with a
+        new merge.
+
+        Params:
+            setup
+                the graphics pack to be merged first, and the merge mode
+            mods
+                a list of (mod, signature) pairs to be merged
+
+        Returns:
+            The statuses of the mods kept from the previous merge, or None if
+            the merge must be started from scratch.
+        """
+        from .mods import read_installation_log
+        if self._checkpoints is None or self._undo is not None:
+            return None
+        merge_log = paths.get('baselines', 'temp', 'raw', 'installed_raws.txt')
+        merged = [c[0] for c in self._checkpoints if c[2] < 3]
+        if setup != self._setup or (
+                read_installation_log(merge_log) != merged):
+            return None
+        kept = 0
+        while kept < min(len(mods), len(self._checkpoints)) and (
+                mods[kept] == self._checkpoints[kept][:2]):
+            kept += 1
+        if any(c[3] is None for c in self._checkpoints[kept:]):
+            return None
+        restored = 0
+        while len(self._checkpoints) > kept:
+            restored += self._undo_changes(self._checkpoints.pop()[3])
+        log.d('Restored {} files to checkpoint {}'.format(restored, kept))
+        return [c[2] for c in self._checkpoints]
+
+    def rollback_step(self):
+        """Undoes the changes made since begin_step, eg by a mod that failed
+        to merge, returning to the last checkpoint."""
+        if self._undo is not None:
+            log.d('Rolled back {} files'.format(self._undo_changes(
+                self._undo)))
+        self._undo = None
+
+    def _undo_changes(self, undo):
+        """Restores the files in an undo log, returning how many there were,
+        and deletes its snapshots."""
+        for filename, snapshot in reversed(list(undo.items())):
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            elif os.path.isfile(filename):
+                os.remove(filename)
+            if snapshot is not None:
+                try:
+                    os.link(snapshot, filename)
+                except (AttributeError, OSError):
+                    shutil.copy2(snapshot, filename)
+            self._lines.pop(filename, None)
+        for folder in set(os.path.dirname(s) for s in undo.values() if s):
+            shutil.rmtree(folder)
+        return len(undo)
+
+    def read_lines(self, filename):
+        """Returns the lines of a file, re-reading it only if it changed
+        (see file_identity).  Returns an empty list if the file cannot
+        be read.  The returned list is shared and must not be modified."""
+        try:
+            st = os.stat(filename)
+        except OSError:
+            log.d(filename + ' cannot be read; merging other files')
+            return []
+        ident = file_identity(st)
+        cached = self._lines.get(filename)
+        if cached is not None and cached[0] == ident:
+            return cached[1]
+        try:
+            with open(filename, encoding='cp437', errors='replace') as f:
+                lines = f.readlines()
+        except IOError:
+            log.d(filename + ' cannot be read; merging other files')
+            return []
+        self._lines[filename] = (ident, lines, _digest(lines))
+        return lines
+
+    def cached_diffs(self, filename, exclude=()):
+        """Returns a dict of the known diffs from the given vanilla file, for
+        use with add_diffs in another process."""
+        self.read_lines(filename)
+        if filename not in self._lines:
+            return {}
+        digest = self._lines[filename][2]
+        return dict((k, v) for k, v in self._diffs.items()
+                    if k[1] == digest and k not in exclude)
+
+    def add_diffs(self, diffs):
+        """Adds diffs computed elsewhere, as from cached_diffs."""
+        for key, ops in diffs.items():
+            if key not in self._diffs and len(self._diffs) >= self.max_diffs:
+                self._diffs.popitem(last=False)
+            self._diffs[key] = ops
+
+    def diff(self, vanilla_text, text):
+        """Returns the opcodes that turn <vanilla_text> into <text> (see
+        get_diff_backend), computing them only if this pair of texts has not
+        been diffed with the current backend."""
+        start = time.time()
+        backend = self.backend or get_diff_backend()
+        key = (backend, _digest(vanilla_text), _digest(text))
+        ops = self._diffs.get(key)
+        if ops is None:
+            self.misses += 1
+            ops = rawdiff.backends[backend](vanilla_text, text)
+            if len(self._diffs) >= self.max_diffs:
+                self._diffs.popitem(last=False)
+        else:
+            self.hits += 1
+            del self._diffs[key]
+        self._diffs[key] = ops
+        self.count_diff(ops, time.time() - start)
+        return ops
+
+    def count_diff(self, ops, seconds):
+        """Adds a diff to the totals for the file being merged."""
+        self.diff_time += seconds
+        self.hunks += sum(1 for op in ops if op[0] != 'equal')
+
+def _digest(lines):
+    """Returns a hash identifying a sequence of lines."""
+    return hashlib.sha1(''.join(lines).encode('utf-8')).digest()
+
+_merge_session = MergeSession(None)
+
+def get_merge_session(baseline=None):
+    """Returns the current MergeSession.  If a baseline path is given and
+    differs from that of the current session, a new session is started."""
+    global _merge_session # pylint:disable=global-statement
+    if baseline is not None and baseline != _merge_session.baseline:
+        _merge_session = MergeSession(baseline)
+    return _merge_session
+
+def new_merge_session(baseline=None):
+    """Replaces the current MergeSession with a new one, and returns it."""
+    global _merge_session # pylint:disable=global-statement
+    _merge_session = MergeSession(baseline)
+    return _merge_session
+
+def merge_cache_key(gfx, list_of_mods):
+    """Returns the key of a merge in the merge cache: a hash of the baseline,
+    diff backend, merge mode, graphics pack and ordered mods, including the
+    contents of the pack and mods."""
+    session = get_merge_session()
+    parts = [os.path.basename(str(session.baseline)), get_diff_backend(),
+             session.mode or 'lines', gfx or '']
+    if gfx:
+        parts.append(session.folder_hash(paths.get('graphics', gfx, 'raw')))
+    for mod in list_of_mods:
+        parts.append([mod, session.folder_hash(paths.get('mods', mod))])
+    return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+def load_cached_merge(key):
+    """Replaces LNP/Baselines/temp with a cached merge, returning the mod
+    statuses of that merge, or None if it is not cached."""
+    entry = paths.get('baselines', 'merge_cache', key)
+    try:
+        with open(os.path.join(entry, 'merge.json')) as f:
+            stored = json.load(f)
+        statuses = stored['statuses']
+        if stored['log'] != _log_digest(entry):
+            raise ValueError('installed_raws.txt changed')
+    except (IOError, OSError, ValueError, KeyError):
+        if os.path.isdir(entry):
+            log.w('Discarding damaged cached merge ' + key)
+            shutil.rmtree(entry)
+        return None
+    os.utime(os.path.join(entry, 'merge.json'), None)
+    get_merge_session().invalidate()
+    if os.path.exists(paths.get('baselines', 'temp')):
+        shutil.rmtree(paths.get('baselines', 'temp'))
+    link_tree(entry, paths.get('baselines', 'temp'), exclude=('merge.json',))
+    return statuses
+
+def store_cached_merge(key, statuses):
+    """Adds the merge in LNP/Baselines/temp to the merge cache, then evicts
+    the least recently used merges beyond the size limit."""
+    entry = paths.get('baselines', 'merge_cache', key)
+    if os.path.isdir(entry) or not os.path.isdir(
+            paths.get('baselines', 'temp')):
+        return
+    partial = entry + '.partial'
+    if os.path.exists(partial):
+        shutil.rmtree(partial)
+    link_tree(paths.get('baselines', 'temp'), partial)
+    size = sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(partial) for f in files)
+    try:
+        digest = _log_digest(partial)
+    except IOError:
+        shutil.rmtree(partial)
+        return
+    with open(os.path.join(partial, 'merge.json'), 'wb') as f:
+        f.write(json.dumps({'statuses': statuses, 'size': size,
+                            'log': digest}).encode('utf-8'))
+    os.rename(partial, entry)
+    prune_merge_cache()
+
+def _log_digest(entry):
+    """Returns a hash of installed_raws.txt in a merge cache entry, to check
+    that the entry was not changed after it was stored."""
+    with open(os.path.join(entry, 'raw', 'installed_raws.txt'), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def prune_merge_cache(limit=None):
+    """Deletes the least recently used merges from the merge cache until its
+    size is at most <limit> bytes; by default the 'merge_cache_mb' user
+    config value, or 256 MB."""
+    if limit is None:
+        limit = (lnp.userconfig.get_number('merge_cache_mb') or 256) << 20
+    entries = []
+    for entry in glob.glob(paths.get('baselines', 'merge_cache', '*')):
+        try:
+            with open(os.path.join(entry, 'merge.json')) as f:
+                size = json.load(f)['size']
+            used = os.path.getmtime(os.path.join(entry, 'merge.json'))
+        except (IOError, OSError, ValueError, KeyError):
+            shutil.rmtree(entry)
+            continue
+        entries.append((used, size, entry))
+    total = sum(e[1] for e in entries)
+    for _, size, entry in sorted(entries):
+        if total <= limit:
+            break
+        log.d('Evicting cached merge ' + os.path.basename(entry))
+        shutil.rmtree(entry)
+        total -= size
@@ -3,13 +3,28 @@
 """Mod Pack management and merging tools."""
 from __future__ import print_function, unicode_literals, absolute_import
 
-import sys, os, shutil, glob, time
-from difflib import ndiff, SequenceMatcher
+import sys, os, shutil, glob, time, json
+from threading import RLock, current_thread
+from collections import OrderedDict
+from difflib import ndiff
+from fnmatch import fnmatch
+from functools import wraps
 # pylint:disable=redefined-builtin
 from io import open
-
-from . import paths, baselines, log, manifest
+try:
+    from concurrent.futures import (
+        ProcessPoolExecutor, ThreadPoolExecutor, wait)
+except ImportError:  # Python 2 without the futures backport
+    ProcessPoolExecutor = ThreadPoolExecutor = wait = None
+
+from . import paths, baselines, helpers, log, manifest, rawdiff
+from .dfraw import object_parents, split_tag, tokenize_raw
 from .lnp import lnp
+from .mergesession import (
+    folder_signature, get_diff_backend, get_merge_session, load_cached_merge,
+    merge_cache_key, new_merge_session, store_cached_merge)
+from .rawdiff import three_way_merge
+from .treesync import break_link, link_tree, sync_tree
 
 def _shutil_wrap(fn):
     def _wrapped_fn(*args, **kwargs):
@@ -29,6 +44,17 @@ if sys.platform == 'win32':
     shutil.rmtree = _shutil_wrap(shutil.rmtree)
     shutil.copytree = _shutil_wrap(shutil.copytree)
 
+# Held while LNP/Baselines/temp or the mods folder is changed, so that a
+# background merge (see MergeJob) cannot overlap another merge or install
+_merge_lock = RLock()
+
+def _with_merge_lock(fn):
+    @wraps(fn)
+    def _locked_fn(*args, **kwargs):
+        with _merge_lock:
+            return fn(*args, **kwargs)
+    return _locked_fn
+
 def toggle_premerge_gfx():
     """Sets the option for pre-merging of graphics."""
     lnp.userconfig['premerge_graphics'] = not lnp.userconfig.get_bool(
@@ -39,6 +65,42 @@ def will_premerge_gfx():
     """Returns whether or not graphics will be merged prior to any mods."""
     return lnp.userconfig.get_bool('premerge_graphics')
 
+def toggle_merge_profiling():
+    """Sets the option for recording merge timings (see export_profile)."""
+    lnp.userconfig['merge_profiling'] = not lnp.userconfig.get_bool(
+        'merge_profiling')
+    lnp.userconfig.save_data()
+
+def will_profile_merges():
+    """Returns whether or not merge timings are recorded."""
+    return lnp.userconfig.get_bool('merge_profiling')
+
+def get_merge_workers():
+    """Returns the number of processes used to merge text files; set
+    'merge_workers' in the user config to override the CPU count."""
+    workers = lnp.userconfig.get_number('merge_workers')
+    if workers > 0:
+        return workers
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:  # Python 2
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+def get_merge_mode():
+    """Returns how text files are merged by default: by 'lines' (default),
+    or by 'objects', which merges raw objects such as [CREATURE:DWARF] and
+    then their tags separately."""
+    mode = lnp.userconfig.get_string('merge_mode')
+    if mode in ('lines', 'objects'):
+        return mode
+    return 'lines'
+
+def set_merge_mode(mode):
+    """Sets the default merge mode (see get_merge_mode)."""
+    lnp.userconfig['merge_mode'] = mode
+    lnp.userconfig.save_data()
+
 def read_mods():
     """Returns a list of mod packs"""
     return [os.path.basename(o) for o in glob.glob(paths.get('mods', '*'))
@@ -56,6 +118,7 @@ def get_tooltip(mod):
     """Returns the tooltip for the given mod."""
     return manifest.get_cfg('mods', mod).get_string('tooltip')
 
+@_with_merge_lock
 def simplify_mods():
     """Removes unnecessary files from all mods."""
     mods, files = 0, 0
@@ -111,21 +174,25 @@ def make_blank_files(pack):
                     i += 1
     return i
 
+@_with_merge_lock
 def install_mods():
-    """Deletes installed raw folder, and copies over merged raws."""
+    """Replaces the installed raw and speech folders with the merged ones,
+    writing only the files that changed (see sync_tree)."""
     merge_log = paths.get('baselines', 'temp', 'raw', 'installed_raws.txt')
     if read_installation_log(merge_log):
-        shutil.rmtree(paths.get('df', 'raw'))
-        shutil.rmtree(paths.get('df', 'data', 'speech'))
-        shutil.copytree(paths.get('baselines', 'temp', 'raw'),
-                        paths.get('df', 'raw'))
-        shutil.copytree(paths.get('baselines', 'temp', 'data', 'speech'),
-                        paths.get('df', 'data', 'speech'))
+        for folder in (('raw',), ('data', 'speech')):
+            written, removed = sync_tree(
+                paths.get('baselines', 'temp', *folder),
+                paths.get('df', *folder), _profile_files)
+            log.i('Installed {}: {} files written, {} removed'.format(
+                '/'.join(folder), written, removed))
         return True
     log.w('To avoid data loss, PyLNP only installs mods if a log exists')
     return False
 
-def merge_all_mods(list_of_mods, gfx=None):
+@_with_merge_lock
+def merge_all_mods(list_of_mods, gfx=None, mode=None, progress=None,
+                   cancelled=None):
     """Merges the specified list of mods, starting with graphics if set to
     pre-merge (or if a pack is specified explicitly).
 
@@ -134,6 +201,14 @@ def merge_all_mods(list_of_mods, gfx=None):
             a list of the names of mods to merge
         gfx
             a graphics pack to be merged in
+        mode
+            'lines' or 'objects' to override the merge mode (see
+            get_merge_mode)
+        progress
+            a function(mod, filename) called after each file is merged
+        cancelled
+            a function returning True to stop the merge; the current mod is
+            rolled back, and it and later mods are left unmerged
 
     Returns:
         A list of status ints for each mod given:
@@ -141,25 +216,114 @@ def merge_all_mods(list_of_mods, gfx=None):
             0:  Merge was successful, all well
             1:  Potential compatibility issues, no merge problems
             2:  Non-fatal error, overlapping lines or non-existent mod etc
-            3:  Fatal error, not returned (rebuilds to previous, rest unmerged)
+            3:  Fatal error, not returned (rolled back, rest unmerged)
     """
     from . import graphics
-    clear_temp()
-    if gfx:
-        add_graphics(gfx)
-    elif will_premerge_gfx():
-        add_graphics(graphics.current_pack())
-    ret_list = []
-    for i, mod in enumerate(list_of_mods):
+    session = get_merge_session(baselines.find_vanilla(False))
+    if not gfx and will_premerge_gfx():
+        gfx = graphics.current_pack()
+    for name in _profile_files:
+        if os.path.isfile(paths.get('baselines', 'temp', 'raw', name)):
+            os.remove(paths.get('baselines', 'temp', 'raw', name))
+    previous_mode, session.mode = session.mode, mode or get_merge_mode()
+    session.progress, session.cancelled = progress, cancelled
+    if will_profile_merges():
+        session.profile = []
+    try:
+        with _MergePool(session):
+            result = _merge_mods(session, list_of_mods, gfx)
+        if session.profile is not None:
+            export_profile(session.profile)
+        return result
+    finally:
+        session.mode = previous_mode
+        session.profile = session.progress = session.cancelled = None
+
+def _merge_mods(session, list_of_mods, gfx):
+    """Implements merge_all_mods, once the graphics pack and merge mode have
+    been chosen."""
+    setup = (gfx, session.mode)
+    signatures = [folder_signature(paths.get('mods', mod))
+                  for mod in list_of_mods]
+    ret_list = session.resume(setup, list(zip(list_of_mods, signatures)))
+    if ret_list is None:
+        ret_list = load_cached_merge(merge_cache_key(gfx, list_of_mods))
+        if ret_list is not None:
+            log.i('Using cached merge of {}'.format(list_of_mods))
+            session.restore(setup, list(zip(list_of_mods, signatures)),
+                            ret_list)
+            return ret_list
+        clear_temp()
+        if gfx:
+            add_graphics(gfx)
+        session.start(setup)
+        ret_list = []
+    else:
+        log.d('Reusing merge of {} mods'.format(len(ret_list)))
+    for i in range(len(ret_list), len(list_of_mods)):
+        mod = list_of_mods[i]
+        if session.is_cancelled():
+            log.i('Merge cancelled before mod {}'.format(mod))
+            return ret_list + [-1]*len(list_of_mods[i:])
+        session.begin_step()
         status = merge_a_mod(mod)
-        ret_list.append(status)
         if status == 3:
-            log.i('Mod {}, in {}, could not be merged.'.format(
-                mod, str(list_of_mods)))
-            merged = merge_all_mods(list_of_mods[:i-1], gfx)
-            return merged + [-1]*len(list_of_mods[i:])
+            if session.is_cancelled():
+                log.i('Merge cancelled in mod {}'.format(mod))
+            else:
+                log.i('Mod {}, in {}, could not be merged.'.format(
+                    mod, str(list_of_mods)))
+            session.rollback_step()
+            store_cached_merge(merge_cache_key(gfx, list_of_mods[:i]),
+                                ret_list)
+            return ret_list + [-1]*len(list_of_mods[i:])
+        session.end_step(mod, signatures[i], status)
+        ret_list.append(status)
+    store_cached_merge(merge_cache_key(gfx, list_of_mods), ret_list)
     return ret_list
 
+# Written by export_profile; never installed (see install_mods)
+_profile_files = ('merge_profile.json', 'merge_profile.csv')
+_profile_fields = ('mod', 'file', 'status', 'read', 'diff', 'merge', 'write',
+                   'vanilla_lines', 'previous_lines', 'mod_lines',
+                   'merged_lines', 'hunks')
+
+def export_profile(profile):
+    """Writes merge timings to merge_profile.json and merge_profile.csv next
+    to installed_raws.txt, and logs a summary of the slowest mods and files.
+
+    Params:
+        profile
+            a list of dicts, one per merged file, with the keys in
+            _profile_fields; times are in seconds
+    """
+    folder = paths.get('baselines', 'temp', 'raw')
+    if not os.path.isdir(folder):
+        return
+    lines = [','.join(_profile_fields)]
+    for row in profile:
+        lines.append(','.join('"{}"'.format(row[k].replace('"', '""')) if k in (
+            'mod', 'file') else str(row[k]) for k in _profile_fields))
+    for name, data in zip(_profile_files, (
+            json.dumps(profile, indent=1), '\n'.join(lines) + '\n')):
+        break_link(os.path.join(folder, name))
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(data.encode('utf-8'))
+    totals = OrderedDict()
+    for row in profile:
+        total = totals.setdefault(row['mod'], [0, 0, 0, 0])
+        for i, k in enumerate(('read', 'diff', 'merge', 'write')):
+            total[i] += row[k]
+    for mod, total in totals.items():
+        log.i('Merged {}: read {:.2f}s, diff {:.2f}s, merge {:.2f}s, '
+              'write {:.2f}s'.format(mod, *total))
+    slowest = sorted(profile, key=lambda r: -(
+        r['read'] + r['diff'] + r['merge'] + r['write']))[:5]
+    for row in slowest:
+        log.i('Slow merge: {} in {}, {:.2f}s, {} hunks'.format(
+            row['file'], row['mod'], row['read'] + row['diff'] +
+            row['merge'] + row['write'], row['hunks']))
+
 def merge_a_mod(mod):
     """Merges the specified mod, and returns an exit code 0-3.
 
@@ -171,12 +335,17 @@ def merge_a_mod(mod):
     log.push_prefix('In "' + mod + '": ')
     if not baselines.find_vanilla_raws():
         log.e('Could not merge: baseline raws unavailable')
+        log.pop_prefix()
         return 3
     log.d('Starting to merge mod: {}'.format(mod))
+    get_merge_session().current_mod = mod
     mod_raw_folder = paths.get('mods', mod, 'raw')
     if not os.path.isdir(mod_raw_folder):
         log.w('mod is invalid; /raw/ must be a directory')
+        log.pop_prefix()
         return 2
+    profile = get_merge_session().profile
+    first_row = len(profile or [])
     status = merge_folder(mod_raw_folder, baselines.find_vanilla_raws(),
                           paths.get('baselines', 'temp', 'raw'))
     if os.path.isdir(paths.get('mods', mod, 'data', 'speech')):
@@ -184,48 +353,190 @@ def merge_a_mod(mod):
             paths.get('mods', mod, 'data', 'speech'),
             os.path.join(baselines.find_vanilla(), 'data', 'speech'),
             paths.get('baselines', 'temp', 'data', 'speech')))
+    for row in (profile or [])[first_row:]:
+        row['mod'] = mod
+        row['file'] = os.path.relpath(row['file'],
+                                      paths.get('baselines', 'temp'))
     if status < 3:
-        with open(paths.get('baselines', 'temp', 'raw', 'installed_raws.txt'),
-                  'a') as f:
-            f.write('mods/' + mod + '\n')
+        merge_log = paths.get('baselines', 'temp', 'raw', 'installed_raws.txt')
+        get_merge_session().record(merge_log)
+        _add_to_log('mods/' + mod)
     log.i('Finished merging')
     log.pop_prefix()
     return status
 
 def merge_folder(mod_folder, vanilla_folder, mixed_folder):
     """Merge the specified folders, output going in 'LNP/Baselines/temp'
-    Text files are merged; other files (sprites etc) are copied over."""
-    status = 0
+    Text files are merged; other files (sprites etc) are copied over.
+
+    With several workers (see get_merge_workers), the text files of large
+    folders are merged in the process pool of the running merge (see
+    _merge_pool).  Logging and results are still processed in file order."""
+    # pylint:disable=too-many-locals,too-many-branches,too-many-statements
+    session = get_merge_session()
+    names = []
     for root, _, files in os.walk(mod_folder):
-        for k in files:
-            f = os.path.relpath(os.path.join(root, k), mod_folder)
+        names.extend(os.path.relpath(os.path.join(root, k), mod_folder)
+                     for k in files)
+    texts = [f for f in names if any([f.endswith(a) for a in (
+        '.txt', '.init')])]
+    executor = _merge_pool(session, len(texts))
+    jobs = {}
+    if executor is not None:
+        for f in texts:
+            van_f = os.path.join(vanilla_folder, f)
+            gen_f = os.path.join(mixed_folder, f)
+            session.record(gen_f)
+            jobs[f] = executor.submit(
+                _merge_file_job, os.path.join(mod_folder, f), van_f, gen_f,
+                get_diff_backend(), session.mode, session.profile is not None,
+                log.get().prefixes + ['file "' + f + '": '],
+                log.get().max_level, session.cached_diffs(van_f))
+    status = 0
+    try:
+        for f in names:
+            if session.is_cancelled():
+                status = 3
+                break
             log.push_prefix('file "' + f + '": ')
             log.d('merging...')
             mod_f = os.path.join(mod_folder, f)
             van_f = os.path.join(vanilla_folder, f)
             gen_f = os.path.join(mixed_folder, f)
-            if any([f.endswith(a) for a in ('.txt', '.init')]):
+            if f in jobs:
+                try:
+                    file_status, lines, diffs, rows = jobs[f].result()
+                except Exception: # pylint:disable=broad-except
+                    log.e('Merging in a worker process failed', stack=True)
+                    file_status, lines, diffs, rows = 3, [], {}, []
+                log.extend(lines)
+                session.add_diffs(diffs)
+                if session.profile is not None:
+                    session.profile.extend(rows)
+                status = max(status, file_status)
+            elif f in texts:
                 # merge raws and DFHack init files
                 status = max(status, merge_file(mod_f, van_f, gen_f))
             elif any([f.endswith(a) for a in ('.lua', '.rb', '.bmp', '.png')]):
                 # copy DFHack scripts or sprite sheets
                 if not os.path.isdir(os.path.dirname(gen_f)):
+                    created = os.path.dirname(gen_f)
+                    while not os.path.isdir(os.path.dirname(created)):
+                        created = os.path.dirname(created)
+                    session.record(created)
                     os.makedirs(os.path.dirname(gen_f))
+                session.record(gen_f)
                 if not os.path.isfile(gen_f):
                     shutil.copy2(mod_f, gen_f)
                     status = max(1, status)
-                else:
-                    with open(mod_f, 'rb') as f:
-                        mb = f.read() # pylint:disable=no-member
-                    with open(gen_f, 'rb') as f:
-                        gb = f.read() # pylint:disable=no-member
-                    if mb != gb:
-                        shutil.copyfile(mod_f, gen_f)
-                        status = max(2, status)
+                elif not helpers.files_equal(mod_f, gen_f):
+                    break_link(gen_f)
+                    shutil.copyfile(mod_f, gen_f)
+                    status = max(2, status)
             log.d('merged with status {}'.format(status))
             log.pop_prefix()
+            if session.progress is not None:
+                session.progress(session.current_mod, f)
+    finally:
+        # Workers already running may still be writing to temp, so wait for
+        # them before the caller rolls back or caches the merge
+        for job in jobs.values():
+            job.cancel()
+        if jobs:
+            wait(list(jobs.values()))
     return status
 
+# Folders with fewer text files are merged in the calling process, as
+# handing files to workers would take longer than merging them
+_min_pool_files = 32
+
+class _MergePool(object):
+    """Allows merge_folder to use a process pool within a with block, and
+    shuts the pool down at the end of the block.  Nested blocks share the
+    pool of the outermost one."""
+    def __init__(self, session):
+        self.session = session
+        self.owner = False
+
+    def __enter__(self):
+        if not self.session.use_pool:
+            self.session.use_pool = self.owner = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.owner:
+            if self.session.executor is not None:
+                self.session.executor.shutdown()
+            self.session.executor = None
+            self.session.use_pool = False
+
+def _merge_pool(session, files):
+    """Returns the process pool of the running merge for a folder with
+    <files> text files, starting it if needed, or None if the folder should
+    be merged in this process.  Outside a _MergePool block, folders are
+    always merged in this process."""
+    if not session.use_pool or ProcessPoolExecutor is None or (
+            get_merge_workers() < 2 or files < _min_pool_files):
+        return None
+    if session.executor is None:
+        kwargs = {}
+        if current_thread().name != 'MainThread':
+            # A forked child holds copies of locks taken by other threads
+            # (eg. the GUI), so start fresh processes instead
+            try:
+                import multiprocessing
+                method = 'spawn'
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    method = 'forkserver'
+                kwargs['mp_context'] = multiprocessing.get_context(method)
+            except AttributeError:  # Python 2
+                return None
+        try:
+            session.executor = ProcessPoolExecutor(
+                get_merge_workers(), **kwargs)
+        except TypeError:  # No mp_context before Python 3.7
+            return None
+    return session.executor
+
+def _merge_file_job(mod_f, van_f, gen_f, backend, mode, profile, prefixes,
+                    level, diffs):
+    """Runs merge_file in a worker process.
+
+    Params:
+        mod_f, van_f, gen_f
+            the files to merge, as for merge_file
+        backend, mode
+            the diff backend and merge mode to use
+        profile
+            whether to record timings (see MergeSession.profile)
+        prefixes, level
+            the logging prefixes and level of the calling process
+        diffs
+            known diffs from the vanilla file, as from
+            MergeSession.cached_diffs
+
+    Returns:
+        tuple(status, log lines, diffs computed by this job, profile rows)
+    """
+    # The worker has no session or logger of its own to take these from
+    # pylint:disable=too-many-arguments
+    session = new_merge_session()
+    session.backend = backend
+    session.mode = mode
+    if profile:
+        session.profile = []
+    session.add_diffs(diffs)
+    logger = log.get()
+    logger.output_err = False
+    logger.prefixes = list(prefixes)
+    logger.set_level(level)
+    start = len(logger.lines)
+    status = merge_file(mod_f, van_f, gen_f)
+    lines = logger.lines[start:]
+    del logger.lines[start:]
+    return (status, lines, session.cached_diffs(van_f, exclude=diffs),
+            session.profile or [])
+
 def merge_file(mod_file_name, van_file_name, gen_file_name):
     """Merges three files, and returns an exit code 0-3.
 
@@ -235,25 +546,42 @@ def merge_file(mod_file_name, van_file_name, gen_file_name):
         3:  Fatal error, respond by rebuilding to previous mod
     """
     #pylint:disable=bare-except
-    van_lines, mod_lines, gen_lines = [], [], []
-    for fname, lines in ((van_file_name, van_lines),
-                         (mod_file_name, mod_lines),
+    session = get_merge_session()
+    times = [time.time()]
+    van_lines = session.read_lines(van_file_name)
+    mod_lines, gen_lines = [], []
+    for fname, lines in ((mod_file_name, mod_lines),
                          (gen_file_name, gen_lines)):
         try:
             with open(fname, encoding='cp437', errors='replace') as f:
                 lines.extend(f.readlines())
         except IOError:
             log.d(fname + ' cannot be read; merging other files')
-    status, gen_lines = merge_line_list(mod_lines, van_lines, gen_lines)
+    times.append(time.time())
+    session.diff_time, session.hunks = 0, 0
+    status, out_lines = merge_line_list(
+        mod_lines, van_lines, gen_lines, session.mode == 'objects')
+    times.append(time.time())
+    session.record(gen_file_name)
     try:
+        break_link(gen_file_name)
         with open(gen_file_name, "w", encoding='cp437') as gen_file:
-            gen_file.writelines(gen_lines)
+            gen_file.writelines(out_lines)
     except:
         log.e('Writing to {} failed'.format(gen_file_name))
         status = 3
+    times.append(time.time())
+    if session.profile is not None:
+        session.profile.append({
+            'mod': '', 'file': gen_file_name, 'status': status,
+            'read': times[1] - times[0], 'diff': session.diff_time,
+            'merge': times[2] - times[1] - session.diff_time,
+            'write': times[3] - times[2], 'vanilla_lines': len(van_lines),
+            'previous_lines': len(gen_lines), 'mod_lines': len(mod_lines),
+            'merged_lines': len(out_lines), 'hunks': session.hunks})
     return status
 
-def merge_line_list(mod_text, vanilla_text, gen_text):
+def merge_line_list(mod_text, vanilla_text, gen_text, by_object=False):
     """Merges sequences of lines.
 
     Params:
@@ -263,6 +591,8 @@ def merge_line_list(mod_text, vanilla_text, gen_text):
             The lines of the corresponding vanilla file.
         gen_text
             The lines of the previously merged file or files.
+        by_object
+            If True, raw object files are merged with merge_object_list.
 
     Returns:
         tuple(status, lines); status is 0/'ok' or 2/'overlap merged'
@@ -279,71 +609,159 @@ def merge_line_list(mod_text, vanilla_text, gen_text):
     if mod_text and gen_text and not vanilla_text:
         log.d('Falling back to two-way merge; no vanilla file exists.')
         return 0, [s[2:] for s in ndiff(gen_text, mod_text)]
+    if by_object:
+        result = merge_object_list(mod_text, vanilla_text, gen_text)
+        if result is not None:
+            return result
+        log.d('not a raw object file; merging by line')
     log.d('performing three-way merge')
-    # SequenceMatcher describes the diff to vanilla
-    gen_ops = SequenceMatcher(None, vanilla_text, gen_text).get_opcodes()
-    mod_ops = SequenceMatcher(None, vanilla_text, mod_text).get_opcodes()
+    # Opcodes describe the diff to vanilla
+    session = get_merge_session()
+    gen_ops = session.diff(vanilla_text, gen_text)
+    mod_ops = session.diff(vanilla_text, mod_text)
     outfile = []
     for block in three_way_merge(gen_text, gen_ops, mod_text, mod_ops):
         outfile.extend(block)
     status = outfile.pop()
     return status, outfile
 
-def three_way_merge(gen_text, van_gen_ops, mod_text, van_mod_ops):
-    """Yield blocks of lines from a three-way-merge.  Last block is status."""
-    status, cur_v, mod_i2, gen_i2 = 0, 0, 1, 1
-    while van_mod_ops and van_gen_ops:
-        if mod_i2 <= cur_v:
-            van_mod_ops.pop(0)
-        if gen_i2 <= cur_v:
-            van_gen_ops.pop(0)
-        _, _, mod_i2, mod_j1, mod_j2 = van_mod_ops[0]
-        gen_tag, _, gen_i2, gen_j1, gen_j2 = van_gen_ops[0]
-        low_i2 = min(mod_i2, gen_i2)
-        if van_mod_ops[0][0] == 'equal':
-            if gen_tag == 'equal':
-                yield gen_text[cur_v:low_i2]
-                cur_v = low_i2
-                continue
-            yield gen_text[gen_j1:gen_j2]
-            cur_v = gen_i2
-            continue
-        if gen_tag == 'equal':
-            yield mod_text[mod_j1:mod_j2]
-            cur_v = mod_i2
-            continue
-        yield mod_text[cur_v:low_i2]
-        if gen_text[cur_v:low_i2] != mod_text[cur_v:low_i2]:
-            status = 2
-            log.d('Overwrite merge at line {}'.format(cur_v))
-            log.v('- ' + '- '.join(gen_text[cur_v:low_i2]) +
-                  '+ ' + '+ '.join(mod_text[cur_v:low_i2]))
-        cur_v = low_i2
-    while van_mod_ops:
-        _, _, _, mod_j1, mod_j2 = van_mod_ops.pop(0)
-        yield mod_text[mod_j1:mod_j2]
-    while van_gen_ops:
-        _, _, _, gen_j1, gen_j2 = van_gen_ops.pop(0)
-        yield gen_text[gen_j1:gen_j2]
-    yield status
+def merge_object_list(mod_text, vanilla_text, gen_text):
+    """Merges sequences of lines from raw object files object by object, so
+    changes to different objects never overlap.  For objects changed in both
+    texts, the tags are merged by three_way_merge.
+
+    Params:
+        mod_text, vanilla_text, gen_text
+            As for merge_line_list.
 
+    Returns:
+        tuple(status, lines) as for merge_line_list, or None if the texts are
+        not all raw object files with unique object IDs.
+    """
+    # pylint:disable=too-many-locals
+    split = [_split_objects(t) for t in (vanilla_text, gen_text, mod_text)]
+    if None in split:
+        return None
+    log.d('performing object merge')
+    (van_head, van_objs), (gen_head, gen_objs), (mod_head, mod_objs) = split
+    status, out = _merge_units(van_head, gen_head, mod_head)
+    for key in list(gen_objs) + [k for k in mod_objs if k not in gen_objs]:
+        van, gen, mod = [d.get(key) for d in (van_objs, gen_objs, mod_objs)]
+        log.push_prefix('{}:{}: '.format(*key))
+        if mod is None and van is not None:
+            # Deleted by the mod, which wins if the object was also changed
+            if gen != van:
+                status = 2
+                log.d('Overwrite merge; object removed')
+            gen = []
+        elif gen is None and van is not None:
+            # Deleted by previous mods, unless changed by this one
+            if mod != van:
+                status = 2
+                log.d('Overwrite merge; removed object restored')
+            gen = [] if mod == van else mod
+        elif gen is None or mod is None:
+            gen = gen or mod
+        else:
+            object_status, gen = _merge_units(van or [], gen, mod)
+            status = max(status, object_status)
+        log.pop_prefix()
+        out.extend(gen)
+    return status, ''.join(out).splitlines(True)
+
+def _split_objects(lines):
+    """Splits the lines of a raw object file into the units before the first
+    object and an OrderedDict of (tag, ID) keys to the units of each object,
+    eg ('CREATURE', 'DWARF').  Each unit is a tag with any whole lines of
+    text before it and the rest of its own line, so that blank lines and
+    comments before an object belong to that object.  Text after the last
+    tag is a unit of its own.
+    Returns None if the lines are not an object file or IDs are repeated."""
+    try:
+        tokens = list(tokenize_raw(''.join(lines)))
+    except Exception: # pylint:disable=broad-except
+        return None
+    head, objects, patterns = [], OrderedDict(), None
+    units, pending = head, ''
+    for kind, token in tokens:
+        if kind == 'Comment':
+            end = token.find('\n') + 1 if units else 0
+            if end:
+                units[-1] += token[:end]
+            pending += token[end:]
+            continue
+        name, value = split_tag(token)
+        if patterns is None:
+            if name == 'OBJECT':
+                patterns = object_parents.get(value)
+        elif any([fnmatch(name, p) for p in patterns]):
+            if (name, value) in objects:
+                return None
+            units = objects[(name, value)] = []
+        units.append(pending + token)
+        pending = ''
+    if patterns is None:
+        return None
+    if pending:
+        units.append(pending)
+    return head, objects
+
+def _merge_units(vanilla, gen, mod):
+    """Three-way merges lists of text units, returning (status, units)."""
+    if mod == vanilla or gen == mod:
+        return 0, gen
+    if gen == vanilla:
+        return 0, mod
+    session = get_merge_session()
+    diff = rawdiff.backends[session.backend or get_diff_backend()]
+    ops = []
+    for text in (gen, mod):
+        start = time.time()
+        ops.append(diff(vanilla, text))
+        session.count_diff(ops[-1], time.time() - start)
+    blocks = list(three_way_merge(gen, ops[0], mod, ops[1]))
+    return blocks.pop()[0], [u for block in blocks for u in block]
+
+def diff_opcodes(a, b):
+    """Returns a list of opcodes (as SequenceMatcher.get_opcodes) that turn
+    the lines <a> into <b>, using the configured diff backend."""
+    return rawdiff.backends[get_diff_backend()](a, b)
+
+@_with_merge_lock
 def clear_temp():
-    """Resets the folder in which raws are mixed."""
+    """Resets the folder in which raws are mixed.  Vanilla files are
+    hardlinked into it where possible, and unlinked before they are
+    written (see break_link)."""
+    get_merge_session().invalidate()
     if not baselines.find_vanilla_raws(False):
         log.e('Could not clear temp: baseline raws unavailable')
         return
     if os.path.exists(paths.get('baselines', 'temp')):
         shutil.rmtree(paths.get('baselines', 'temp'))
-    shutil.copytree(baselines.find_vanilla_raws(),
-                    paths.get('baselines', 'temp', 'raw'))
-    shutil.rmtree(paths.get('baselines', 'temp', 'raw', 'graphics'))
-    shutil.copytree(os.path.join(baselines.find_vanilla(), 'data', 'speech'),
-                    paths.get('baselines', 'temp', 'data', 'speech'))
-    with open(paths.get('baselines', 'temp', 'raw', 'installed_raws.txt'),
-              'w') as f:
+    link_tree(baselines.find_vanilla_raws(),
+               paths.get('baselines', 'temp', 'raw'), exclude=('graphics',))
+    link_tree(os.path.join(baselines.find_vanilla(), 'data', 'speech'),
+               paths.get('baselines', 'temp', 'data', 'speech'))
+    merge_log = paths.get('baselines', 'temp', 'raw', 'installed_raws.txt')
+    break_link(merge_log)
+    with open(merge_log, 'w') as f:
         f.write('# List of raws merged by PyLNP:\nbaselines/' +
                 os.path.basename(baselines.find_vanilla()) + '\n')
 
+def _add_to_log(line):
+    """Adds a line to installed_raws.txt in LNP/Baselines/temp.  The file is
+    rewritten rather than appended to, as it may be hardlinked into the
+    merge cache."""
+    merge_log = paths.get('baselines', 'temp', 'raw', 'installed_raws.txt')
+    try:
+        with open(merge_log) as f:
+            text = f.read()
+    except IOError:
+        text = ''
+    break_link(merge_log)
+    with open(merge_log, 'w') as f:
+        f.write(text + line + '\n')
+
 def update_raw_dir(path, gfx=('', '')):
     """Updates a raw dir in place with specified graphics and raws.
     Returns:
@@ -355,16 +773,47 @@ def update_raw_dir(path, gfx=('', '')):
             Tuple of graphics pack to update to,
             and pack installed in baselines/temp/
     """
-    mods_list = read_installation_log(os.path.join(path, 'installed_raws.txt'))
+    return update_raw_dirs([path], gfx) is not None
+
+@_with_merge_lock
+def update_raw_dirs(raw_dirs, gfx=('', '')):
+    """Updates raw dirs built from the same mods in place, merging the raws
+    once and copying them to every dir in parallel.
+    Returns:
+        An OrderedDict of the seconds taken to copy each dir, or None if
+        aborted.
+    Arguments:
+        raw_dirs
+            the full paths of the dirs to update; the mods are read from the
+            installation log of the first
+        gfx
+            Tuple of graphics pack to update to,
+            and pack installed in baselines/temp/
+    """
+    mods_list = read_installation_log(
+        os.path.join(raw_dirs[0], 'installed_raws.txt'))
     built_log = paths.get('baselines', 'temp', 'raw', 'installed_raws.txt')
     built_mods = read_installation_log(built_log)
     if mods_list != built_mods or gfx[0] != gfx[1]:
         if -1 in merge_all_mods(mods_list, gfx[0]):
-            log.w('Some mods in {} could not be remerged'.format(path))
-            return False
-    shutil.rmtree(path)
-    shutil.copytree(paths.get('baselines', 'temp', 'raw'), path)
-    return True
+            log.w('Some mods in {} could not be remerged'.format(
+                ', '.join(raw_dirs)))
+            return None
+    src = paths.get('baselines', 'temp', 'raw')
+    def sync(path):
+        """Copies the merge to <path>, returning the time taken."""
+        start = time.time()
+        sync_tree(src, path, _profile_files)
+        return time.time() - start
+    if ThreadPoolExecutor is None or len(raw_dirs) == 1:
+        times = [sync(path) for path in raw_dirs]
+    else:
+        # Copying mostly waits on the disk, so use a few threads even on a
+        # single core
+        workers = min(len(raw_dirs), max(4, get_merge_workers()))
+        with ThreadPoolExecutor(workers) as pool:
+            times = list(pool.map(sync, raw_dirs))
+    return OrderedDict(zip(raw_dirs, times))
 
 def add_graphics(gfx):
     """Adds graphics to the mod merge in baselines/temp."""
@@ -376,10 +825,9 @@ def add_graphics(gfx):
         if not os.path.isdir(dst):
             os.makedirs(dst)
         for f in files:
+            break_link(os.path.join(dst, f))
             shutil.copy2(os.path.join(root, f), dst)
-    with open(paths.get('baselines', 'temp', 'raw', 'installed_raws.txt'),
-              'a') as f:
-        f.write('graphics/{}\n'.format(graphics.get_folder_prefix(gfx)))
+    _add_to_log('graphics/' + graphics.get_folder_prefix(gfx))
     log.i('{} graphics added (small mod compatibility risk)'.format(gfx))
 
 def can_rebuild(log_file, strict=True):
@@ -391,6 +839,7 @@ def can_rebuild(log_file, strict=True):
     mod_list = read_installation_log(log_file)
     return all([m in read_mods() for m in mod_list])
 
+@_with_merge_lock
 def make_mod_from_installed_raws(name):
     """Capture whatever unavailable mods a user currently has installed
     as a mod called $name.
@@ -398,6 +847,11 @@ def make_mod_from_installed_raws(name):
         * If `installed_raws.txt` is not present, compare to vanilla
         * Otherwise, rebuild as much as possible then compare to installed
     """
+    with _MergePool(get_merge_session()):
+        return _make_mod_from_installed_raws(name)
+
+def _make_mod_from_installed_raws(name):
+    """Implements make_mod_from_installed_raws."""
     if get_installed_mods_from_log():
         clear_temp()
         for mod in get_installed_mods_from_log():
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Line diffs and three-way merges, as used to merge mods."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+from bisect import bisect_left
+from difflib import SequenceMatcher
+
+from . import log
+
+def difflib_opcodes(a, b):
+    """Diffs with difflib.SequenceMatcher."""
+    return SequenceMatcher(None, a, b).get_opcodes()
+
+def patience_opcodes(a, b):
+    """Diffs with patience diff, falling back to Myers' algorithm between
+    unique lines.  Lines are interned to integers first, so comparisons are
+    cheap and no lines are treated as junk."""
+    # pylint:disable=too-many-branches
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in a]
+    b = [ids.setdefault(line, len(ids)) for line in b]
+    matches = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo, blo = alo + 1, blo + 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi, bhi = ahi - 1, bhi - 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = _unique_common_lines(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            for i, j in anchors:
+                stack.append((alo, i, blo, j))
+                matches.append((i, j))
+                alo, blo = i + 1, j + 1
+            stack.append((alo, ahi, blo, bhi))
+        else:
+            matches.extend(_myers_matches(a, alo, ahi, b, blo, bhi))
+    matches.sort()
+    opcodes = []
+    i = j = 0
+    for ai, bj in matches + [(len(a), len(b))]:
+        if i < ai and j < bj:
+            opcodes.append(('replace', i, ai, j, bj))
+        elif i < ai:
+            opcodes.append(('delete', i, ai, j, bj))
+        elif j < bj:
+            opcodes.append(('insert', i, ai, j, bj))
+        if ai < len(a):
+            if opcodes and opcodes[-1][0] == 'equal':
+                opcodes[-1] = ('equal', opcodes[-1][1], ai + 1,
+                               opcodes[-1][3], bj + 1)
+            else:
+                opcodes.append(('equal', ai, ai + 1, bj, bj + 1))
+        i, j = ai + 1, bj + 1
+    return opcodes
+
+def _unique_common_lines(a, alo, ahi, b, blo, bhi):
+    """Returns the longest increasing sequence of (i, j) pairs where a[i] and
+    b[j] are equal and occur exactly once in a[alo:ahi] and b[blo:bhi]."""
+    # Ranges are passed as indices, as slicing would copy the lines
+    # pylint:disable=too-many-arguments,too-many-locals
+    counts = {}
+    for i in range(alo, ahi):
+        counts[a[i]] = (counts[a[i]][0] + 1, i) if a[i] in counts else (1, i)
+    in_b = {}
+    for j in range(blo, bhi):
+        if counts.get(b[j], (0,))[0] == 1:
+            in_b[b[j]] = None if b[j] in in_b else j
+    pairs = sorted((counts[k][1], j) for k, j in in_b.items() if j is not None)
+    # Patience sorting: tails[n] is the smallest j ending an increasing run of
+    # length n + 1; back links rebuild the longest run
+    tails, tail_pairs, back = [], [], {}
+    for pair in pairs:
+        n = bisect_left(tails, pair[1])
+        back[pair] = tail_pairs[n - 1] if n else None
+        if n == len(tails):
+            tails.append(pair[1])
+            tail_pairs.append(pair)
+        else:
+            tails[n] = pair[1]
+            tail_pairs[n] = pair
+    result = []
+    pair = tail_pairs[-1] if tail_pairs else None
+    while pair is not None:
+        result.append(pair)
+        pair = back[pair]
+    return result[::-1]
+
+# Myers' algorithm takes time and memory quadratic in the number of changed
+# lines; gaps between unique lines needing more edits than this are matched
+# by SequenceMatcher (without its junk heuristic) instead
+_max_myers_edits = 400
+
+def _myers_matches(a, alo, ahi, b, blo, bhi):
+    """Returns the matching (i, j) pairs of a shortest edit script between
+    a[alo:ahi] and b[blo:bhi], found with Myers' O(ND) algorithm.  Ranges
+    needing more than _max_myers_edits edits are matched with
+    SequenceMatcher instead, which finds the longest matching blocks
+    rather than a shortest edit script."""
+    # As for _unique_common_lines
+    # pylint:disable=too-many-arguments,too-many-locals,too-many-branches
+    n, m = ahi - alo, bhi - blo
+    # v[k + off] is the furthest x reached on diagonal k; trace[d] keeps
+    # diagonals -d - 1 to d + 1 as they were before step d
+    off = n + m + 1
+    v = [-1] * (2 * off + 1)
+    v[off + 1] = 0
+    trace = []
+    for d in range(min(n + m, _max_myers_edits) + 1):
+        trace.append(v[off - d - 1:off + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[off + k - 1] < v[off + k + 1]):
+                x = v[off + k + 1]
+            else:
+                x = v[off + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x, y = x + 1, y + 1
+            v[off + k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    else:
+        return [(alo + i + t, blo + j + t) for i, j, size in SequenceMatcher(
+            None, a[alo:ahi], b[blo:bhi], False).get_matching_blocks()
+                for t in range(size)]
+    matches = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k + d] < v[k + d + 2]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k + d + 1]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x, y = x - 1, y - 1
+            matches.append((alo + x, blo + y))
+        if d > 0:
+            x, y = prev_x, prev_y
+    return matches
+
+backends = {
+    'patience': patience_opcodes,
+    'difflib': difflib_opcodes,
+}
+
+def three_way_merge(gen_text, van_gen_ops, mod_text, van_mod_ops):
+    """Yield blocks of lines from a three-way-merge.  Last block is [status].
+
+    Changes from vanilla in either text are combined.  Where both change the
+    same vanilla lines in different ways, the mod text is used (status 2)."""
+    # pylint:disable=too-many-locals
+    gen_hunks = [op[1:] for op in van_gen_ops if op[0] != 'equal']
+    mod_hunks = [op[1:] for op in van_mod_ops if op[0] != 'equal']
+    # Cursors into the hunk lists, and line offsets from vanilla to each text
+    status, cur_v, gen_i, mod_i, gen_d, mod_d = 0, 0, 0, 0, 0, 0
+    while gen_i < len(gen_hunks) or mod_i < len(mod_hunks):
+        # Start a region at whichever text changes vanilla first
+        if mod_i == len(mod_hunks) or (
+                gen_i < len(gen_hunks) and
+                gen_hunks[gen_i][0] <= mod_hunks[mod_i][0]):
+            start, end = gen_hunks[gen_i][:2]
+        else:
+            start, end = mod_hunks[mod_i][:2]
+        yield gen_text[cur_v + gen_d:start + gen_d]
+        # Grow the region while the next hunk of either text overlaps it
+        gen_first, mod_first = gen_i, mod_i
+        while True:
+            if gen_i < len(gen_hunks) and _overlaps(
+                    gen_hunks[gen_i], start, end):
+                end = max(end, gen_hunks[gen_i][1])
+                gen_i += 1
+            elif mod_i < len(mod_hunks) and _overlaps(
+                    mod_hunks[mod_i], start, end):
+                end = max(end, mod_hunks[mod_i][1])
+                mod_i += 1
+            else:
+                break
+        gen_block = gen_text[start + gen_d:end + _offset_after(
+            gen_hunks, gen_first, gen_i, gen_d)]
+        mod_block = mod_text[start + mod_d:end + _offset_after(
+            mod_hunks, mod_first, mod_i, mod_d)]
+        if gen_i == gen_first:
+            yield mod_block
+        elif mod_i == mod_first:
+            yield gen_block
+        else:
+            yield mod_block
+            if gen_block != mod_block:
+                status = 2
+                log.d('Overwrite merge at line {}'.format(start))
+                log.v('- ' + '- '.join(gen_block) +
+                      '+ ' + '+ '.join(mod_block))
+        gen_d = _offset_after(gen_hunks, gen_first, gen_i, gen_d)
+        mod_d = _offset_after(mod_hunks, mod_first, mod_i, mod_d)
+        cur_v = end
+    yield gen_text[cur_v + gen_d:]
+    yield [status]
+
+def _overlaps(hunk, start, end):
+    """Returns True if the hunk (i1, i2, j1, j2) touches the vanilla region
+    [start, end).  Insertions at either edge of a region count as touching
+    it, since their order relative to the region would be ambiguous."""
+    i1, i2 = hunk[:2]
+    return i1 < end or (i1 == end and (i1 == i2 or start == end))
+
+def _offset_after(hunks, first, last, offset):
+    """Returns the vanilla-to-text line offset after hunks[first:last], or
+    <offset> if that range is empty."""
+    if last > first:
+        return hunks[last - 1][3] - hunks[last - 1][1]
+    return offset
@@ -4,6 +4,7 @@
 from __future__ import print_function, unicode_literals, absolute_import
 
 import sys, os, re
+from functools import total_ordering
 from .dfraw import DFRaw
 from . import log, hacks
 
@@ -26,6 +27,66 @@ class _NegatedBool(object):
 
 _negated_bool = _NegatedBool()
 
+@total_ordering
+class Version(object):
+    """Container for a version number for easy comparisons."""
+    __slots__ = ('version_str', 'data')
+    #Known errors in release notes
+    _corrections = {"0.23.125.23a": "0.23.130.23a"}
+    # Comparison tuples for all version strings parsed so far
+    _parsed = {}
+
+    def __init__(self, version):
+        self.version_str = Version._corrections.get(version, version)
+        self.data = Version.parse(version)
+
+    @staticmethod
+    def parse(version):
+        """Returns the comparison tuple for the version string <version>.
+        Results are cached, since the same literals are compared often."""
+        try:
+            return Version._parsed[version]
+        except KeyError:
+            pass
+        s = ""
+        data = []
+        for c in Version._corrections.get(version, version):
+            if c < '0' or c > '9':
+                data.append(int(s))
+                if c != '.':
+                    data.append(c)
+                s = ""
+            else:
+                s = s + c
+        if s != '':
+            data.append(int(s))
+        data = Version._parsed[version] = tuple(data)
+        return data
+
+    @staticmethod
+    def _data(other):
+        """Returns the comparison tuple for a Version, tuple or string."""
+        if isinstance(other, Version):
+            return other.data
+        if isinstance(other, tuple):
+            return other
+        return Version.parse(other)
+
+    def __lt__(self, other):
+        return self.data < Version._data(other)
+
+    def __eq__(self, other):
+        return self.data == Version._data(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.data)
+
+    def __str__(self):
+        return self.version_str
+
 # Format: Key = tag name, value = list of version numbers
 # First value indicates first version with the tag
 # Second value, if present, indicates first version WITHOUT the tag
@@ -331,6 +392,34 @@ _option_version_data = {
     'INVASION_MONSTER_CAP': ['0.42.01'],
 }
 
+# _option_version_data with the versions parsed into comparison tuples
+_option_versions = dict(
+    (k, tuple(Version.parse(v) for v in versions))
+    for k, versions in _option_version_data.items())
+
+# Sets of available options, by version tuple
+_options_by_version = {}
+
+def options_for_version(version):
+    """Returns a frozenset of the options in _option_version_data that exist in
+    DF <version> (a Version or version string). Computed once per version."""
+    # pylint:disable=protected-access
+    version = Version._data(version)
+    if version not in _options_by_version:
+        _options_by_version[version] = frozenset(
+            k for k, v in _option_versions.items()
+            if v[0] <= version and (len(v) == 1 or version < v[1]))
+    return _options_by_version[version]
+
+# Matches at the [ of every tag: group 1 is the name, group 2 the value (None
+# for flags). Zero-width so tags nested inside other tag values are also found.
+_tag_re = re.compile(r'\[(?=([^\[\]:\n]+)(?::(.+?))?\])')
+
+def scan_tags(text):
+    """Returns a list of (name, value) pairs for all tags in <text>, in order
+    of appearance. value is None for flags written as [NAME]."""
+    return [m.groups() for m in _tag_re.finditer(text)]
+
 def _option_item_to_value(item):
     """Removes any validation expression from <item>."""
     if not isinstance(item, basestring):
@@ -643,23 +732,27 @@ class DFConfiguration(object):
             calling create_option(field_name, field_name, value, None,
             (filename,)).
         """
-        text = DFRaw.read(filename)
+        tags = scan_tags(DFRaw.read(filename))
+        values, flags = {}, set()
+        for name, value in tags:
+            if value is None:
+                flags.add(name)
+            else:
+                values.setdefault(name, value)
         if auto_add:
-            for match in re.findall(r'\[(.+?):(.+?)\]', text):
-                self.create_option(
-                    match[0], match[0], match[1], None, (filename,))
+            for name, value in tags:
+                if value is not None:
+                    self.create_option(name, name, value, None, (filename,))
         for field in fields:
             if field in self.inverse_field_names:
                 field = self.inverse_field_names[field]
             if self.options[field] is _disabled:
                 # If there is a single match, flag the option as enabled
-                if "[{0}]".format(self.field_names[field]) in text:
+                if self.field_names[field] in flags:
                     self.settings[field] = "YES"
             else:
-                match = re.search(r'\[{0}:(.+?)\]'.format(
-                    self.field_names[field]), text)
-                if match:
-                    value = match.group(1)
+                value = values.get(self.field_names[field])
+                if value is not None:
                     if self.options[field] is _negated_bool:
                         value = ["YES", "NO"][["NO", "YES"].index(value)]
                     self.settings[field] = value
@@ -688,22 +781,50 @@ class DFConfiguration(object):
             max_params
                 The maximum number of parameters for the field. -1 for no limit.
         """
+        return DFConfiguration.inventory_has_field(
+            DFConfiguration.read_tag_inventory(filename), field, num_params,
+            min_params, max_params)
+
+    @staticmethod
+    def read_tag_inventory(filename):
+        """
+        Returns a dict mapping the name of each tag with parameters in
+        <filename> to its number of parameters, as seen on the first
+        occurrence of the tag. Returns an empty dict if the file cannot be
+        read.
+
+        Params:
+            filename
+                The file to read.
+        """
         try:
-            match = re.search(
-                r'\['+str(field)+r'(:.+?)\]', DFRaw.read(filename))
-            if match is None:
-                return False
-            params = match.group(1)
-            param_count = params.count(":")
-            if num_params != -1 and param_count != num_params:
-                return False
-            if min_params != -1 and param_count < min_params:
-                return False
-            if max_params != -1 and param_count > max_params:
-                return False
-            return True
+            tags = scan_tags(DFRaw.read(filename))
         except IOError:
+            return {}
+        inventory = {}
+        for name, value in tags:
+            if value is not None and name not in inventory:
+                inventory[name] = value.count(':') + 1
+        return inventory
+
+    @staticmethod
+    def inventory_has_field(
+            inventory, field, num_params=-1, min_params=-1, max_params=-1):
+        """
+        Returns True if <field> exists in <inventory> (see read_tag_inventory)
+        and has the specified number of parameters. Parameters are as for
+        has_field.
+        """
+        if field not in inventory:
             return False
+        param_count = inventory[field]
+        if num_params != -1 and param_count != num_params:
+            return False
+        if min_params != -1 and param_count < min_params:
+            return False
+        if max_params != -1 and param_count > max_params:
+            return False
+        return True
 
     def write_settings(self):
         """Write all settings to their respective files."""
@@ -770,11 +891,7 @@ class DFConfiguration(object):
             log.w("Unknown option: %s", option_name)
             # Unknown option, must be a later DF than this knows about
             return False
-        option = _option_version_data[option_name]
-        if len(option) == 2:
-            return option[0] <= self.df_info.version < option[1]
-        else:
-            return option[0] <= self.df_info.version
+        return option_name in options_for_version(self.df_info.version)
 
     def __str__(self):
         return (
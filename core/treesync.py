@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Copying and installing folders of merged files."""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import sys, os, errno, shutil
+
+from . import helpers
+
+def link_tree(src, dst, exclude=()):
+    """Recreates the folder <src> at <dst>, hardlinking files where the
+    filesystem allows it and copying them otherwise.  Top-level items named
+    in <exclude> are skipped."""
+    for root, dirs, files in os.walk(src):
+        if root == src:
+            dirs[:] = [d for d in dirs if d not in exclude]
+            files = [f for f in files if f not in exclude]
+        target = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for f in files:
+            try:
+                os.link(os.path.join(root, f), os.path.join(target, f))
+            except (AttributeError, OSError):
+                shutil.copy2(os.path.join(root, f), os.path.join(target, f))
+
+def break_link(filename):
+    """Removes <filename> if it is hardlinked to another file (see
+    link_tree), so that writing it cannot change the baseline.  Only use
+    this before the file is replaced completely.
+
+    If the file cannot be removed, it is replaced by a copy of its own; if
+    that fails too, the error is raised rather than risk writing through
+    the link."""
+    try:
+        if os.stat(filename).st_nlink <= 1:
+            return
+    except OSError as ex:
+        if ex.errno == errno.ENOENT:
+            return
+        raise
+    try:
+        os.remove(filename)
+    except OSError as ex:
+        if ex.errno == errno.ENOENT:
+            return
+        shutil.copy2(filename, filename + '.lnp-new')
+        _replace(filename + '.lnp-new', filename)
+
+def sync_tree(src, dst, exclude=()):
+    """Makes the folder <dst> an exact copy of <src>, writing only the files
+    that differ.  Top-level files of <src> named in <exclude> are not copied,
+    and are removed from <dst>.
+
+    The new tree is staged next to <dst>, with unchanged files hardlinked
+    from it, and swapped in with two renames.  Where that is not possible
+    (no hardlinks, or a file in <dst> is in use) <dst> is updated in place
+    instead, replacing each changed file in one step.  A swap interrupted by
+    a crash is undone on the next call.
+
+    Returns:
+        A tuple (files written, files removed).
+    """
+    staged, old = dst + '.lnp-new', dst + '.lnp-old'
+    if not os.path.isdir(dst) and os.path.isdir(old):
+        os.rename(old, dst)
+    for leftover in (staged, old):
+        if os.path.isdir(leftover):
+            shutil.rmtree(leftover)
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    changed, removed = _diff_tree(src, dst, exclude)
+    if not changed and not removed:
+        return 0, 0
+    try:
+        _stage_tree(src, dst, staged, changed, exclude)
+        os.rename(dst, old)
+    except (AttributeError, OSError):
+        shutil.rmtree(staged, ignore_errors=True)
+        _update_tree(src, dst, changed, removed)
+        return len(changed), len(removed)
+    try:
+        os.rename(staged, dst)
+    except OSError:
+        os.rename(old, dst)
+        shutil.rmtree(staged, ignore_errors=True)
+        _update_tree(src, dst, changed, removed)
+    else:
+        shutil.rmtree(old, ignore_errors=True)
+    return len(changed), len(removed)
+
+def _diff_tree(src, dst, exclude):
+    """Returns sorted lists of the relative paths of files in <src> that are
+    missing or different in <dst>, and of files only in <dst>.  Files in
+    <src> named in <exclude> are ignored, so they count as only in <dst>."""
+    def walk(top):
+        found = set()
+        for root, _, files in os.walk(top):
+            rel = os.path.relpath(root, top)
+            found.update(os.path.normpath(os.path.join(rel, f)) for f in files)
+        return found
+    src_files, dst_files = walk(src) - set(exclude), walk(dst)
+    changed = [f for f in src_files if f not in dst_files or
+               not helpers.files_equal(os.path.join(src, f),
+                                       os.path.join(dst, f))]
+    # Write the installation log last, so it is never newer than the raws
+    changed.sort(key=lambda f: (f == 'installed_raws.txt', f))
+    return changed, sorted(dst_files - src_files)
+
+def _stage_tree(src, dst, staged, changed, exclude):
+    """Builds the contents of <src> at <staged>, copying the <changed> files
+    and hardlinking the rest from <dst>, except those named in <exclude>."""
+    changed = set(changed)
+    for root, _, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        target = os.path.normpath(os.path.join(staged, rel))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for f in files:
+            name = os.path.normpath(os.path.join(rel, f))
+            if name in exclude:
+                continue
+            if name in changed:
+                shutil.copy2(os.path.join(root, f), os.path.join(target, f))
+            else:
+                os.link(os.path.join(dst, name), os.path.join(target, f))
+
+def _update_tree(src, dst, changed, removed):
+    """Updates <dst> in place from <src>, as found by _diff_tree."""
+    for name in changed:
+        target = os.path.join(dst, name)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        shutil.copy2(os.path.join(src, name), target + '.lnp-new')
+        _replace(target + '.lnp-new', target)
+    for name in removed:
+        os.remove(os.path.join(dst, name))
+    for root, _, _ in os.walk(dst, topdown=False):
+        if root != dst and not os.listdir(root) and not os.path.isdir(
+                os.path.join(src, os.path.relpath(root, dst))):
+            os.rmdir(root)
+
+def _replace(src, dst):
+    """Renames <src> to <dst>, replacing <dst> if it exists."""
+    try:
+        os.replace(src, dst)
+    except AttributeError:  # Python 2
+        if sys.platform == 'win32' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
@@ -2,11 +2,14 @@
 # -*- coding: utf-8 -*-
 """This file is used to launch the program."""
 from __future__ import absolute_import
-import sys, os
+import sys, os, multiprocessing
 sys.path.insert(0, os.path.dirname(__file__))
 #pylint: disable=redefined-builtin
 __package__ = ""
 
 from core import lnp
 
-lnp.PyLNP()
+if __name__ == '__main__':
+    # Mod merging may start worker processes, which import this file
+    multiprocessing.freeze_support()
+    lnp.PyLNP()
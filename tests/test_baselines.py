@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for core.baselines.  Run from the PyLNP folder with
+``python -m unittest discover tests``."""
+from __future__ import print_function, unicode_literals, absolute_import
+import os
+import sys
+import unittest
+
+# The PyLNP folder, for core, and this folder, for the shared fixtures
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint:disable=wrong-import-position
+from core import baselines, paths
+from test_mods import MergeTestCase
+
+class RemoveVanillaTest(MergeTestCase):
+    """Checks which files remove_vanilla_raws_from_pack removes."""
+    def test_line_endings(self):
+        """Text files differing from vanilla only in line endings are
+        removed; other files must match byte for byte."""
+        os.makedirs(paths.get('mods', 'pack', 'raw'))
+        for name in ('a.txt', 'b.init', 'c.lua', 'd.png'):
+            for folder, text in (
+                    (paths.get('baselines', 'df_40_24', 'raw'), b'1\n2\n'),
+                    (paths.get('mods', 'pack', 'raw'), b'1\r\n2\r\n')):
+                with open(os.path.join(folder, name), 'wb') as f:
+                    f.write(text)
+        self.assertEqual(baselines.remove_vanilla_raws_from_pack(
+            'pack', 'mods'), 3)
+        self.assertEqual(os.listdir(paths.get('mods', 'pack', 'raw')),
+                         ['d.png'])
+
+if __name__ == '__main__':
+    unittest.main()
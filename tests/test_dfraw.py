@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for core.dfraw.  Run from the PyLNP folder with
+``python -m unittest discover tests``."""
+from __future__ import print_function, unicode_literals, absolute_import
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# pylint:disable=wrong-import-position
+from core.dfraw import DFRaw, parse_cache, tokenize_raw
+
+def reference_tokenize_raw(text):
+    """The tokenizer used before the single-pass regex, kept to compare
+    results with."""
+    while text:
+        curr_string = ''
+        if text[0] == '[':
+            if ']' not in text:
+                raise Exception('Found non-terminated tag: '+text[0:100])
+            curr_string = text[:text.find(']')+1]
+            node_type = 'Tag'
+        if text[0] == '!':
+            match = re.match('!\\w+!', text)
+            if match:
+                curr_string = match.group()
+                node_type = 'Tag'
+        if not curr_string:
+            if '[' in text:
+                curr_string = text[:text.find('[')]
+            else:
+                curr_string = text
+            match = re.search('!\\w+!', text)
+            if match:
+                curr_string = curr_string[:match.start()]
+            node_type = 'Comment'
+        text = text[len(curr_string):]
+        yield node_type, curr_string
+
+# Pieces of raw-like text, weighted towards the ones that delimit tokens
+_pieces = ['[', ']', '!', ':', '\n', '\t', ' ', 'A', 'b', '_', '1', '~',
+           'creature', '[CREATURE:DWARF]', '[FLAG]', '!FLAG!', '!!', '[]',
+           'é']
+
+class TokenizeRawTest(unittest.TestCase):
+    """Compares tokenize_raw with the previous tokenizer."""
+    def assertSameTokens(self, text):
+        """Checks that both tokenizers give the same tokens, or both fail."""
+        try:
+            expected = list(reference_tokenize_raw(text))
+        except Exception: # pylint:disable=broad-except
+            expected = None
+        if expected is None:
+            with self.assertRaises(Exception):
+                list(tokenize_raw(text))
+        else:
+            self.assertEqual(list(tokenize_raw(text)), expected, repr(text))
+
+    def test_examples(self):
+        """Checks typical raw text and edge cases."""
+        for text in (
+                '', 'creature_standard\n\n[OBJECT:CREATURE]\n',
+                '[CREATURE:DWARF]\n\t[NAME:dwarf:dwarves:dwarven]!FLAG!x',
+                'text!NOT A FLAG!', '![TAG]', '[A]![B]!', '[unterminated',
+                'ok[A]then[', '!!', '!a!b!c!'):
+            self.assertSameTokens(text)
+
+    def test_random(self):
+        """Checks random text built from raw-like pieces."""
+        rng = random.Random(1234)
+        for _ in range(5000):
+            self.assertSameTokens(''.join(rng.choice(_pieces) for _ in range(
+                rng.randint(0, 40))))
+
+class RawCacheTest(unittest.TestCase):
+    """Checks that parse_cache notices replaced files."""
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_replaced_with_same_mtime(self):
+        """A same-size file copied over with its mtime kept is re-read."""
+        path = os.path.join(self.folder, 'init.txt')
+        other = os.path.join(self.folder, 'other.txt')
+        for f, text in ((path, '[SOUND:YES]'), (other, '[SOUND:NO!]')):
+            with open(f, 'w') as fh:
+                fh.write(text)
+        self.assertEqual(DFRaw.read(path), '[SOUND:YES]')
+        hits = parse_cache.hits
+        self.assertEqual(DFRaw.read(path), '[SOUND:YES]')
+        self.assertEqual(parse_cache.hits, hits + 1)
+        st = os.stat(path)
+        os.utime(other, (st.st_atime, st.st_mtime))
+        os.remove(path)
+        os.rename(other, path)
+        self.assertEqual(DFRaw.read(path), '[SOUND:NO!]')
+
+class PeekValuesTest(unittest.TestCase):
+    """Checks DFRaw.peek_values."""
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_stops_early(self):
+        """Values are found without tokenizing the rest of the file, which
+        here would fail on an unterminated tag."""
+        path = os.path.join(self.folder, 'init.txt')
+        with open(path, 'w') as f:
+            f.write('[SOUND:YES][VOLUME:255]\n[FONT:curses_640x300.png]'
+                    '[EMPTY:]\n[UNTERMINATED')
+        self.assertEqual(DFRaw.peek_values(
+            path, 'VOLUME', ('SOUND', 'EMPTY'), 3), ['255', ['YES', None],
+                                                     None])
+        with self.assertRaises(Exception):
+            DFRaw.peek_values(path, 'MISSING')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,654 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests for core.mods.  Run from the PyLNP folder with
+``python -m unittest discover tests``."""
+from __future__ import print_function, unicode_literals, absolute_import
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# pylint:disable=wrong-import-position
+from core import (
+    baselines, conflicts, log, mergejob, mergesession, mods, paths, rawdiff,
+    treesync)
+from core.json_config import JSONConfiguration
+
+def apply_opcodes(a, b, opcodes):
+    """Rebuilds <b> from <a> and opcodes, checking that equal ranges match."""
+    result, i = [], 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        assert i1 == i, 'opcodes must cover a in order'
+        if tag == 'equal':
+            assert a[i1:i2] == b[j1:j2]
+            result.extend(a[i1:i2])
+        else:
+            result.extend(b[j1:j2])
+        i = i2
+    assert i == len(a)
+    return result
+
+class PatienceDiffTest(unittest.TestCase):
+    """Checks the patience diff backend."""
+    def test_random(self):
+        """Opcodes turn a into b."""
+        rng = random.Random(42)
+        for _ in range(2000):
+            a = [str(rng.randint(0, 6)) for _ in range(rng.randint(0, 50))]
+            b = [str(rng.randint(0, 6)) for _ in range(rng.randint(0, 50))]
+            opcodes = rawdiff.patience_opcodes(a, b)
+            self.assertEqual(apply_opcodes(a, b, opcodes), b)
+
+    def test_myers_is_shortest(self):
+        """Myers' algorithm finds a longest common subsequence."""
+        rng = random.Random(7)
+        for _ in range(300):
+            a = [rng.randint(0, 3) for _ in range(rng.randint(0, 30))]
+            b = [rng.randint(0, 3) for _ in range(rng.randint(0, 30))]
+            lcs = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+            for i in range(len(a) - 1, -1, -1):
+                for j in range(len(b) - 1, -1, -1):
+                    lcs[i][j] = lcs[i + 1][j + 1] + 1 if a[i] == b[j] else max(
+                        lcs[i + 1][j], lcs[i][j + 1])
+            matches = rawdiff._myers_matches(a, 0, len(a), b, 0, len(b))
+            self.assertEqual(len(matches), lcs[0][0])
+            self.assertTrue(all(a[i] == b[j] for i, j in matches))
+
+    def test_repetitive_gap(self):
+        """Edits far apart in a long run of repeated lines give separate
+        small hunks, not one hunk spanning the run."""
+        plans = ['[BODY_DETAIL_PLAN:STANDARD_MATERIALS]\n',
+                 '[BODY_DETAIL_PLAN:STANDARD_TISSUES]\n',
+                 '[BODY_DETAIL_PLAN:VERTEBRATE_TISSUE_LAYERS:SKIN:FAT:MUSCLE:'
+                 'BONE:CARTILAGE]\n']
+        for length in (600, 5000):
+            a = [plans[i % 3] for i in range(length)]
+            b = list(a)
+            b[10], b[length - 10] = plans[2], plans[0]
+            opcodes = rawdiff.patience_opcodes(a, b)
+            self.assertEqual(apply_opcodes(a, b, opcodes), b)
+            changed = [op for op in opcodes if op[0] != 'equal']
+            self.assertTrue(all(op[2] - op[1] <= 3 for op in changed),
+                            changed)
+
+    def test_whole_file_rewrite(self):
+        """A file with every line replaced is diffed as a single hunk,
+        without running Myers' algorithm over the whole file."""
+        a = ['[OLD:{}]\n'.format(i) for i in range(20000)]
+        b = ['[NEW:{}]\n'.format(i) for i in range(20000)]
+        self.assertEqual(rawdiff.patience_opcodes(a, b),
+                         [('replace', 0, len(a), 0, len(b))])
+
+def random_edits(rng, length, count):
+    """Returns up to <count> random (start, end, new lines) edits of a text
+    with <length> lines, in order and with unchanged lines between them."""
+    edits, pos = [], 0
+    for _ in range(count):
+        start = pos + rng.randint(1, 4)
+        end = start + rng.randint(0, 3)
+        if end > length:
+            break
+        new = ['new {} {}\n'.format(start, rng.random()) for _ in range(
+            rng.randint(0 if end > start else 1, 3))]
+        edits.append((start, end, new))
+        pos = end
+    return edits
+
+def apply_edits(lines, edits):
+    """Returns the lines with the (start, end, new lines) edits made."""
+    result, pos = [], 0
+    for start, end, new in sorted(edits, key=lambda e: e[:2]):
+        result.extend(lines[pos:start] + new)
+        pos = end
+    return result + lines[pos:]
+
+class ThreeWayMergeTest(unittest.TestCase):
+    """Checks three_way_merge with random edits of a text."""
+    vanilla = ['vanilla {}\n'.format(i) for i in range(60)]
+
+    def merge(self, backend, gen, mod):
+        """Returns (status, lines) from merging gen and mod."""
+        diff = rawdiff.backends[backend]
+        blocks = list(rawdiff.three_way_merge(
+            gen, diff(self.vanilla, gen), mod, diff(self.vanilla, mod)))
+        return blocks.pop()[0], [line for block in blocks for line in block]
+
+    def test_disjoint(self):
+        """Edits to different lines are all kept, with status 0."""
+        rng = random.Random(3)
+        for backend in rawdiff.backends:
+            for _ in range(1500):
+                edits = random_edits(rng, len(self.vanilla), 8)
+                mine = [rng.random() < 0.5 for _ in edits]
+                gen = apply_edits(self.vanilla, [
+                    e for e, m in zip(edits, mine) if not m])
+                mod = apply_edits(self.vanilla, [
+                    e for e, m in zip(edits, mine) if m])
+                self.assertEqual(self.merge(backend, gen, mod), (
+                    0, apply_edits(self.vanilla, edits)), backend)
+
+    def test_overlapping(self):
+        """Where both texts change the same lines, the mod's version of
+        those lines is used, with status 2; other edits are kept."""
+        rng = random.Random(4)
+        for backend in rawdiff.backends:
+            for _ in range(1500):
+                edits = random_edits(rng, len(self.vanilla), 6)
+                # Replace one edit by a pair of different, overlapping
+                # changes
+                edits = [e for e in edits if e[1] > e[0]]
+                if not edits:
+                    continue
+                i = rng.randrange(len(edits))
+                start, end, new = edits[i]
+                lo = start + rng.randint(0, end - start - 1)
+                hi = lo + 1 + rng.randint(0, end - lo - 1)
+                gen_edit = (lo, hi, ['gen {}\n'.format(lo)] * rng.randint(
+                    1, 2))
+                if rng.random() < 0.5:
+                    mod_edit, gen_edit = (start, end, new), gen_edit
+                else:
+                    mod_edit, gen_edit = gen_edit, (start, end, new)
+                others = edits[:i] + edits[i + 1:]
+                mine = [rng.random() < 0.5 for _ in others]
+                gen = apply_edits(self.vanilla, [gen_edit] + [
+                    e for e, m in zip(others, mine) if not m])
+                mod = apply_edits(self.vanilla, [mod_edit] + [
+                    e for e, m in zip(others, mine) if m])
+                merged = (start, end, apply_edits(
+                    self.vanilla[start:end], [(mod_edit[0] - start,
+                                               mod_edit[1] - start,
+                                               mod_edit[2])]))
+                self.assertEqual(self.merge(backend, gen, mod), (
+                    2, apply_edits(self.vanilla, others + [merged])),
+                                 backend)
+
+class FakeLNP(object):
+    """Stands in for the PyLNP object, with default user settings."""
+    # pylint:disable=too-few-public-methods
+    class DFInfo(object):
+        """Version information for the baseline df_40_24."""
+        source = 'test'
+        version = '0.40.24'
+
+    def __init__(self):
+        self.userconfig = JSONConfiguration(None)
+        self.df_info = self.DFInfo()
+
+def read_tree(folder):
+    """Returns a dict of the relative paths and contents of files in a
+    folder."""
+    result = {}
+    for root, _, files in os.walk(folder):
+        for f in files:
+            with open(os.path.join(root, f), 'rb') as fh:
+                result[os.path.relpath(os.path.join(root, f), folder)] = (
+                    fh.read())
+    return result
+
+class MergeTestCase(unittest.TestCase):
+    """Sets up a baseline and mods in a temporary LNP folder.  Each mod
+    changes one line of a vanilla creature file; mods named 'bad...' also
+    copy a script, then fail to write a file into a missing folder."""
+    vanilla = ['creature_test\n', '\n', '[OBJECT:CREATURE]\n'] + [
+        '[CREATURE:C{}]\n'.format(i) for i in range(30)]
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.addCleanup(paths.clear)
+        for name in ('baselines', 'mods', 'graphics'):
+            paths.register(name, self.folder, name.capitalize())
+        fake = FakeLNP()
+        for module in (mods, mergesession, baselines):
+            self.addCleanup(setattr, module, 'lnp', module.lnp)
+            module.lnp = fake
+        log.get().push_level(log.ERROR)
+        self.addCleanup(log.get().pop_level)
+        mods.get_merge_session(None).invalidate()
+        self.addCleanup(mods.get_merge_session(None).invalidate)
+        self.write(paths.get('baselines', 'df_40_24', 'raw', 'objects',
+                             'creature_test.txt'), self.vanilla)
+        self.write(paths.get('baselines', 'df_40_24', 'data', 'speech',
+                             'test.txt'), ['vanilla speech\n'])
+
+    @staticmethod
+    def write(filename, lines):
+        """Writes lines to a file, creating its folder."""
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.writelines(lines)
+
+    def make_mod(self, name, line):
+        """Creates a mod changing the given line of the vanilla file."""
+        lines = list(self.vanilla)
+        lines[line] = lines[line].replace(']', ':{}]'.format(name))
+        raw = paths.get('mods', name, 'raw')
+        self.write(os.path.join(raw, 'objects', 'creature_test.txt'), lines)
+        if name.startswith('bad'):
+            self.write(os.path.join(raw, name + '.lua'), ['-- script\n'])
+            self.write(os.path.join(raw, 'missing', 'file.txt'), ['x\n'])
+            shutil.rmtree(paths.get('baselines', 'df_40_24', 'raw',
+                                    'missing'), ignore_errors=True)
+
+    def clean_merge(self, list_of_mods):
+        """Merges mods without reusing checkpoints or cached merges, and
+        returns (statuses, files in temp)."""
+        mods.get_merge_session().invalidate()
+        shutil.rmtree(paths.get('baselines', 'merge_cache'),
+                      ignore_errors=True)
+        statuses = mods.merge_all_mods(list_of_mods)
+        return statuses, read_tree(paths.get('baselines', 'temp'))
+
+class ObjectMergeTest(MergeTestCase):
+    """Checks merging raw object files object by object."""
+    vanilla_objects = (
+        'creature_test\n\n[OBJECT:CREATURE]\n\n'
+        '[CREATURE:A]\n\t[NAME:a:as:a]\n\t[SPEED:20]\n\n'
+        '[CREATURE:B]\n\t[NAME:b:bs:b]\n\t[SPEED:10]\n')
+
+    def merge(self, gen, mod):
+        """Merges edited copies of vanilla_objects by object, returning
+        (status, text)."""
+        status, lines = mods.merge_line_list(
+            mod.splitlines(True), self.vanilla_objects.splitlines(True),
+            gen.splitlines(True), by_object=True)
+        return status, ''.join(lines)
+
+    def test_disjoint_tags(self):
+        """Different tags of the same object are changed by both texts."""
+        v = self.vanilla_objects
+        self.assertEqual(self.merge(
+            v.replace('[SPEED:20]', '[SPEED:22]'),
+            v.replace('[NAME:a:as:a]', '[NAME:x:xs:x]')), (
+                0, v.replace('[SPEED:20]', '[SPEED:22]').replace(
+                    '[NAME:a:as:a]', '[NAME:x:xs:x]')))
+
+    def test_both_add_objects(self):
+        """Objects added by both texts are all kept, in order."""
+        v = self.vanilla_objects
+        self.assertEqual(self.merge(
+            v + '\n[CREATURE:C]\n\t[SPEED:5]\n',
+            v + '\n[CREATURE:D]\n\t[SPEED:6]\n'), (
+                0, v + '\n[CREATURE:C]\n\t[SPEED:5]\n'
+                '\n[CREATURE:D]\n\t[SPEED:6]\n'))
+
+    def test_append_after_edit(self):
+        """An object appended after an object whose last tag was changed
+        by the other text does not overlap that change."""
+        v = self.vanilla_objects
+        added = '\n[CREATURE:C]\n\t[SPEED:5]\n'
+        for gen, mod in ((v.replace('[SPEED:10]', '[SPEED:12]'), v + added),
+                         (v + added, v.replace('[SPEED:10]', '[SPEED:12]'))):
+            self.assertEqual(self.merge(gen, mod), (
+                0, v.replace('[SPEED:10]', '[SPEED:12]') + added))
+        # The same, with a blank line at the end of the vanilla file
+        self.vanilla_objects = v + '\n'
+        self.assertEqual(self.merge(
+            v.replace('[SPEED:10]', '[SPEED:12]') + '\n', v + added), (
+                0, v.replace('[SPEED:10]', '[SPEED:12]') + added))
+
+    def test_delete(self):
+        """An object deleted by one text is removed, with its leading blank
+        line; if the other text changed it, the mod wins with status 2."""
+        v = self.vanilla_objects
+        without_a = v.replace(
+            '\n[CREATURE:A]\n\t[NAME:a:as:a]\n\t[SPEED:20]\n', '')
+        edited_b = v.replace('[SPEED:10]', '[SPEED:12]')
+        self.assertEqual(self.merge(edited_b, without_a), (
+            0, without_a.replace('[SPEED:10]', '[SPEED:12]')))
+        self.assertEqual(self.merge(without_a, edited_b), (
+            0, without_a.replace('[SPEED:10]', '[SPEED:12]')))
+        self.assertEqual(self.merge(
+            v.replace('[SPEED:20]', '[SPEED:22]'), without_a), (2, without_a))
+
+class CheckpointTest(MergeTestCase):
+    """Checks that merges resumed from checkpoints match clean merges."""
+    def test_reorder(self):
+        """Moving a mod re-merges from the change, restoring earlier files
+        from snapshots kept on disk rather than in memory."""
+        names = ['m{}'.format(i) for i in range(5)]
+        for i, name in enumerate(names):
+            self.make_mod(name, 3 + i)
+        vanilla = read_tree(paths.get('baselines', 'df_40_24'))
+        reordered = names[:2] + [names[3], names[2], names[4]]
+        expected = self.clean_merge(reordered)
+        self.clean_merge(names)
+        merged = []
+        self.assertEqual(mods.merge_all_mods(
+            reordered, progress=lambda mod, f: merged.append(mod)),
+                         expected[0])
+        self.assertEqual(read_tree(paths.get('baselines', 'temp')),
+                         expected[1])
+        self.assertEqual(merged, reordered[2:])
+        session = mods.get_merge_session()
+        for checkpoint in session._checkpoints: # pylint:disable=protected-access
+            self.assertTrue(all(v is None or os.path.isfile(v)
+                                for v in checkpoint[3].values()))
+        self.assertEqual(read_tree(paths.get('baselines', 'df_40_24')),
+                         vanilla)
+
+    def test_same_size_edit(self):
+        """A mod file replaced by one of the same size and mtime, as when
+        extracted from a zip, is merged again rather than reused."""
+        self.make_mod('m0', 3)
+        self.make_mod('m1', 4)
+        self.clean_merge(['m0', 'm1'])
+        mod_file = paths.get('mods', 'm1', 'raw', 'objects',
+                             'creature_test.txt')
+        st = os.stat(mod_file)
+        with open(mod_file) as f:
+            text = f.read()
+        replacement = mod_file + '.new'
+        with open(replacement, 'w') as f:
+            f.write(text.replace(':m1]', ':M1]'))
+        os.utime(replacement, (st.st_atime, st.st_mtime))
+        os.remove(mod_file)
+        os.rename(replacement, mod_file)
+        statuses = mods.merge_all_mods(['m0', 'm1'])
+        self.assertEqual((statuses, read_tree(paths.get('baselines', 'temp'))),
+                         self.clean_merge(['m0', 'm1']))
+
+class RollbackTest(MergeTestCase):
+    """Checks that mods which fail to merge are rolled back."""
+    def test_several_failures(self):
+        """Each list is merged on top of checkpoints left by another list.
+        The result matches a clean merge of the mods before the first
+        failure, and the failed and later mods are reported as unmerged."""
+        for i in range(5):
+            self.make_mod('m{}'.format(i), 3 + i)
+        self.make_mod('bad1', 3)
+        self.make_mod('bad2', 20)
+        vanilla = read_tree(paths.get('baselines', 'df_40_24'))
+        for list_of_mods in (['m0', 'bad1', 'm1', 'bad2'],
+                             ['m0', 'm1', 'bad1'],
+                             ['bad1', 'bad2'],
+                             ['m0', 'm1', 'm2', 'bad2', 'm3', 'm4']):
+            good = list_of_mods[:min(list_of_mods.index(b) for b in (
+                'bad1', 'bad2') if b in list_of_mods)]
+            expected = self.clean_merge(good)
+            self.clean_merge(['m0', 'm1', 'm3', 'm4', 'm2'])
+            statuses = mods.merge_all_mods(list_of_mods)
+            self.assertEqual(statuses, expected[0] + [-1] * (
+                len(list_of_mods) - len(good)), list_of_mods)
+            self.assertEqual(read_tree(paths.get('baselines', 'temp')),
+                             expected[1], list_of_mods)
+            self.assertEqual(log.get().prefixes, [])
+        self.assertEqual(read_tree(paths.get('baselines', 'df_40_24')),
+                         vanilla)
+
+class CancelTest(MergeTestCase):
+    """Checks that cancelling a merge rolls back the mod being merged."""
+    def test_cancel_with_workers(self):
+        """Files still being merged by worker processes when the merge is
+        cancelled are rolled back too."""
+        if mods.ProcessPoolExecutor is None:
+            self.skipTest('no process pool')
+        mods.lnp.userconfig['merge_workers'] = 2
+        self.make_mod('m0', 3)
+        raw = paths.get('mods', 'big', 'raw', 'objects')
+        vanilla = ['[CREATURE:C{}]\n'.format(i) for i in range(2000)]
+        for i in range(mods._min_pool_files):
+            lines = list(vanilla)
+            lines[i::50] = ['[CREATURE:BIG]\n'] * len(lines[i::50])
+            self.write(paths.get('baselines', 'df_40_24', 'raw', 'objects',
+                                 'creature_{}.txt'.format(i)), vanilla)
+            self.write(os.path.join(raw, 'creature_{}.txt'.format(i)), lines)
+        expected = self.clean_merge(['m0'])
+        self.clean_merge([])
+        # Cancels as soon as the files of 'big' are handed to the workers
+        session = mods.get_merge_session()
+        self.assertEqual(mods.merge_all_mods(
+            ['m0', 'big'], cancelled=lambda: session.current_mod == 'big'),
+                         [expected[0][0], -1])
+        self.assertEqual(read_tree(paths.get('baselines', 'temp')),
+                         expected[1])
+
+class ConflictReportTest(MergeTestCase):
+    """Checks conflict_report."""
+    def test_report_during_merge(self):
+        """A report made while a merge holds the merge lock finds conflicts
+        without using the shared merge session."""
+        for name, line in (('m0', 3), ('m1', 3), ('m2', 5)):
+            self.make_mod(name, line)
+        shared = mods.get_merge_session(paths.get('baselines', 'df_40_24'))
+        locked, release = threading.Event(), threading.Event()
+        def hold_lock():
+            """Holds the merge lock, as a running merge would."""
+            with mods._merge_lock: # pylint:disable=protected-access
+                locked.set()
+                release.wait()
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        try:
+            locked.wait()
+            report = list(conflicts.conflict_report(['m0', 'm1', 'm2']))
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(report, [{
+            'file': os.path.join('raw', 'objects', 'creature_test.txt'),
+            'mods': ['mods/m0', 'mods/m1', 'mods/m2'],
+            'conflicts': [{'start': 3, 'end': 4,
+                           'mods': ['mods/m0', 'mods/m1']}]}])
+        self.assertEqual(shared.hits + shared.misses, 0)
+
+class MergeJobTest(MergeTestCase):
+    """Checks merging in the background with MergeJob."""
+    def test_log_prefixes(self):
+        """Prefixes pushed by the merge thread do not apply to messages
+        logged by other threads."""
+        self.make_mod('m0', 3)
+        logger = log.get()
+        logger.push_level(log.DEBUG)
+        self.addCleanup(logger.pop_level)
+        logged = []
+        def progress(job, mod, filename):
+            """Logs from this thread while the merge thread is in a mod."""
+            # pylint:disable=unused-argument
+            done = threading.Event()
+            def log_other():
+                """Logs a message from another thread."""
+                log.d('from another thread')
+                logged.append(logger.lines[-1])
+                done.set()
+            threading.Thread(target=log_other).start()
+            done.wait()
+        job = mergejob.MergeJob(['m0'])
+        job.register_progress(progress)
+        self.assertEqual(job.start().result(), [0])
+        self.assertEqual(logged, ['DEBUG: from another thread\n'])
+
+class SyncTreeTest(MergeTestCase):
+    """Checks installing a merged tree with sync_tree."""
+    def setUp(self):
+        MergeTestCase.setUp(self)
+        self.src = os.path.join(self.folder, 'src')
+        self.dst = os.path.join(self.folder, 'dst')
+        for name, text in (('same.txt', 'same\n'), ('new.txt', 'new\n'),
+                           (os.path.join('sub', 'changed.txt'), 'new\n'),
+                           ('skipped.txt', 'skipped\n')):
+            self.write(os.path.join(self.src, name), [text])
+        for name, text in (('same.txt', 'same\n'), ('gone.txt', 'gone\n'),
+                           (os.path.join('sub', 'changed.txt'), 'old\n'),
+                           (os.path.join('empty', 'gone.txt'), 'gone\n')):
+            self.write(os.path.join(self.dst, name), [text])
+        self.expected = read_tree(self.src)
+        del self.expected['skipped.txt']
+
+    def sync(self):
+        """Syncs dst with src, skipping skipped.txt."""
+        return treesync.sync_tree(self.src, self.dst, ('skipped.txt',))
+
+    def check_synced(self):
+        """Checks that dst matches src, without leftover folders."""
+        self.assertEqual(read_tree(self.dst), self.expected)
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'empty')))
+        self.assertEqual([f for f in os.listdir(self.folder)
+                          if f.startswith('dst')], ['dst'])
+        self.assertEqual(self.sync(), (0, 0))
+
+    def test_staged_swap(self):
+        """Changed files are written and others removed; unchanged files
+        are kept as they were.  Excluded files are not copied."""
+        same = os.stat(os.path.join(self.dst, 'same.txt'))
+        self.assertEqual(self.sync(), (2, 2))
+        self.assertEqual(os.stat(os.path.join(self.dst, 'same.txt')).st_ino,
+                         same.st_ino)
+        self.check_synced()
+
+    def test_in_place(self):
+        """Without hardlinks, dst is updated in place."""
+        same = os.stat(os.path.join(self.dst, 'same.txt'))
+        with mock.patch.object(treesync.os, 'link', side_effect=OSError):
+            self.assertEqual(self.sync(), (2, 2))
+        self.assertEqual(os.stat(os.path.join(self.dst, 'same.txt')).st_ino,
+                         same.st_ino)
+        self.check_synced()
+
+    def test_interrupted_swap(self):
+        """A swap interrupted between its two renames is undone first."""
+        os.rename(self.dst, self.dst + '.lnp-old')
+        self.write(os.path.join(self.dst + '.lnp-new', 'partial.txt'), ['x'])
+        self.assertEqual(self.sync(), (2, 2))
+        self.check_synced()
+
+class UpdateRawDirsTest(MergeTestCase):
+    """Checks updating the raws of saves with update_raw_dirs."""
+    def make_save(self, name, list_of_mods):
+        """Returns the raw folder of a save built from the given mods."""
+        mods.merge_all_mods(list_of_mods)
+        raw = os.path.join(self.folder, 'save', name, 'raw')
+        treesync.sync_tree(paths.get('baselines', 'temp', 'raw'), raw)
+        return raw
+
+    def test_update(self):
+        """Saves built from the same mods are updated from one merge."""
+        self.make_mod('m0', 3)
+        self.make_mod('m1', 4)
+        saves = [self.make_save(name, ['m0']) for name in ('a', 'b')]
+        expected = read_tree(paths.get('baselines', 'temp', 'raw'))
+        for raw in saves:
+            self.write(os.path.join(raw, 'objects', 'creature_test.txt'),
+                       self.vanilla)
+        # temp now holds another merge, so the mods are merged again
+        self.make_save('other', ['m1'])
+        result = mods.update_raw_dirs(saves)
+        self.assertEqual(list(result), saves)
+        for raw in saves:
+            self.assertEqual(read_tree(raw), expected)
+        self.assertEqual(read_installation_log(), ['m0'])
+        # Now temp holds the right merge, which is only copied
+        self.write(os.path.join(saves[0], 'objects', 'creature_test.txt'),
+                   self.vanilla)
+        with mock.patch.object(mods, 'merge_all_mods') as merge:
+            mods.update_raw_dirs(saves[:1])
+        self.assertFalse(merge.called)
+        self.assertEqual(read_tree(saves[0]), expected)
+
+    def test_failed_merge(self):
+        """Saves are left alone if their mods cannot be merged."""
+        self.make_mod('bad1', 3)
+        raw = os.path.join(self.folder, 'save', 'a', 'raw')
+        self.write(os.path.join(raw, 'installed_raws.txt'), ['mods/bad1\n'])
+        before = read_tree(raw)
+        self.assertIsNone(mods.update_raw_dirs([raw]))
+        self.assertEqual(read_tree(raw), before)
+
+def read_installation_log():
+    """Returns the mods in installed_raws.txt in LNP/Baselines/temp."""
+    return mods.read_installation_log(paths.get(
+        'baselines', 'temp', 'raw', 'installed_raws.txt'))
+
+class MergeCacheTest(MergeTestCase):
+    """Checks the cache of finished merges."""
+    def merge_uncached(self, list_of_mods):
+        """Merges without checkpoints, returning (statuses, files in temp,
+        mods actually merged)."""
+        mods.clear_temp()
+        merged = []
+        statuses = mods.merge_all_mods(
+            list_of_mods, progress=lambda mod, f: merged.append(mod))
+        return statuses, read_tree(paths.get('baselines', 'temp')), merged
+
+    def test_load_and_store(self):
+        """A merge is served from the cache, and stays unchanged when more
+        mods are merged on top of it."""
+        for i in range(3):
+            self.make_mod('m{}'.format(i), 3 + i)
+        first = self.merge_uncached(['m0', 'm1'])
+        self.assertEqual(first[2], ['m0', 'm1'])
+        entries = os.listdir(paths.get('baselines', 'merge_cache'))
+        self.assertEqual(len(entries), 1)
+        entry = paths.get('baselines', 'merge_cache', entries[0])
+        stored = read_tree(entry)
+        self.assertEqual(self.merge_uncached(['m0', 'm1']), first[:2] + ([],))
+        mods.merge_all_mods(['m0', 'm1', 'm2'])
+        self.assertEqual(read_tree(entry), stored)
+        self.assertEqual(self.merge_uncached(['m0', 'm1']), first[:2] + ([],))
+
+    def test_discard_damaged(self):
+        """An entry whose installation log changed is discarded and the
+        mods merged again."""
+        self.make_mod('m0', 3)
+        first = self.merge_uncached(['m0'])
+        entry = paths.get('baselines', 'merge_cache', os.listdir(paths.get(
+            'baselines', 'merge_cache'))[0])
+        merge_log = os.path.join(entry, 'raw', 'installed_raws.txt')
+        os.remove(merge_log)
+        self.write(merge_log, ['mods/other\n'])
+        self.assertEqual(self.merge_uncached(['m0']), first)
+
+    def test_prune(self):
+        """The least recently used entries are evicted beyond the limit."""
+        for i in range(3):
+            self.make_mod('m{}'.format(i), 3 + i)
+            self.merge_uncached(['m{}'.format(i)])
+        cache = paths.get('baselines', 'merge_cache')
+        entries = sorted(os.listdir(cache), key=lambda e: os.path.getmtime(
+            os.path.join(cache, e, 'merge.json')))
+        with open(os.path.join(cache, entries[-1], 'merge.json')) as f:
+            size = json.load(f)['size']
+        mergesession.prune_merge_cache(size)
+        self.assertEqual(os.listdir(cache), entries[-1:])
+        mergesession.prune_merge_cache(0)
+        self.assertEqual(os.listdir(cache), [])
+
+class PoolTest(MergeTestCase):
+    """Checks the lifetime of the process pool used to merge files."""
+    def test_make_mod_from_installed_raws(self):
+        """Capturing installed raws may merge in a process pool, which is
+        shut down before it returns."""
+        if mods.ProcessPoolExecutor is None:
+            self.skipTest('no process pool')
+        mods.lnp.userconfig['merge_workers'] = 2
+        paths.register('df', self.folder, 'df')
+        for i in range(mods._min_pool_files):
+            name = 'creature_{}.txt'.format(i)
+            self.write(paths.get('baselines', 'df_40_24', 'raw', 'objects',
+                                 name), self.vanilla)
+            self.write(paths.get('df', 'raw', 'objects', name), self.vanilla)
+        self.write(paths.get('df', 'data', 'speech', 'test.txt'),
+                   ['vanilla speech\n'])
+        session = mods.get_merge_session()
+        with mock.patch.object(mods, 'ProcessPoolExecutor', wraps=(
+                mods.ProcessPoolExecutor)) as pool:
+            mods.make_mod_from_installed_raws('captured')
+        self.assertEqual(pool.call_count, 1)
+        self.assertIsNone(session.executor)
+        self.assertFalse(session.use_pool)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,7 +23,7 @@ from . import controls, binding, tkhelpers
 from .layout import GridLayouter
 from .tab import Tab
 
-from core import colors, graphics, paths
+from core import colors, graphics, mergejob, paths
 from core.lnp import lnp
 
 # pylint:disable=too-many-public-methods,too-many-instance-attributes
@@ -222,6 +222,7 @@ class GraphicsTab(Tab):
                     '\n\nAny manually installed mods will be removed in the '
                     'process.\n\nAre you sure you want to continue?',
                     title='Are you sure?'):
+                mergejob.cancel_merge_job()
                 result = graphics.install_graphics(gfx_dir)
                 if result is False:
                     messagebox.showerror(
@@ -262,6 +263,7 @@ class GraphicsTab(Tab):
     @staticmethod
     def update_savegames():
         """Updates saved games with new raws."""
+        mergejob.cancel_merge_job()
         count, skipped = graphics.update_savegames()
         if count + skipped == 0:
             messagebox.showinfo(
@@ -25,7 +25,8 @@ from . import controls, tkhelpers
 from .layout import GridLayouter
 from .tab import Tab
 
-from core import mods
+from core import mergejob, mods
+from core.lnp import lnp
 
 # pylint:disable=too-many-public-methods
 class ModsTab(Tab):
@@ -36,8 +37,12 @@ class ModsTab(Tab):
         self.installed_var = Variable()
         self.available_var = Variable()
         self.status = 3
+        self.merge_job = None
+        self.merge_text = StringVar()
+        self.progress_pending = False
 
     def read_data(self):
+        self.stop_merge()
         mods.clear_temp()
         self.available = mods.read_mods()
         self.installed = mods.get_installed_mods_from_log()
@@ -80,6 +85,10 @@ class ModsTab(Tab):
         self.available_list.bind(
             "<Double-1>", lambda e: self.add_to_installed())
         main_grid.add(f, 2)
+        main_grid.add(Label(self, textvariable=self.merge_text), 2)
+        root = self.winfo_toplevel()
+        root.bind('<<MergeProgress>>', lambda e: self.show_merge_progress())
+        root.bind('<<MergeFinished>>', lambda e: self.show_merge_result())
 
         main_grid.add(controls.create_trigger_button(
             self, 'Install Mods', 'Copy merged mods to DF folder.',
@@ -154,6 +163,7 @@ class ModsTab(Tab):
 
     def create_from_installed(self):
         """Extracts a mod from the currently installed raws."""
+        self.stop_merge()
         if mods.make_mod_from_installed_raws('') is not None:
             name = simpledialog.askstring("Create Mod", "New mod name:")
             if name:
@@ -191,17 +201,75 @@ class ModsTab(Tab):
         self.perform_merge()
 
     def perform_merge(self):
-        """Merge the selected mods, with background color for user feedback."""
+        """Starts merging the selected mods in the background, cancelling any
+        merge in progress.  See show_merge_result."""
         if not tkhelpers.check_vanilla_raws():
             return
+        self.status = 3
+        for i in range(len(self.installed)):
+            self.installed_list.itemconfig(i, bg='white')
+        self.merge_text.set('Merging...')
+        job = mergejob.MergeJob(self.installed)
+        job.register_progress(self.on_merge_progress)
+        job.register_end(lambda j: lnp.ui.queue.put('<<MergeFinished>>'))
+        self.merge_job = job.start()
+
+    def stop_merge(self):
+        """Cancels any merge in progress, and waits for it to stop."""
+        if self.merge_job is not None:
+            self.merge_job.cancel()
+            # pylint:disable=broad-except
+            try:
+                self.merge_job.result()
+            except Exception:
+                pass # Logged by the job
+            self.merge_text.set('')
+
+    #pylint: disable=unused-argument
+    def on_merge_progress(self, job, mod, filename):
+        """Event handler for merge progress, called in the merge thread."""
+        if not self.progress_pending:
+            self.progress_pending = True
+            lnp.ui.queue.put('<<MergeProgress>>')
+
+    def show_merge_progress(self):
+        """Shows how many files of the mod being merged are done."""
+        self.progress_pending = False
+        job = self.merge_job
+        if job is not None and not job.done():
+            self.merge_text.set('Merging {}... ({}/{} files)'.format(
+                job.current_mod, job.files_done, job.files_total))
+
+    def show_merge_result(self):
+        """Colors the merged mods by status when the current merge ends;
+        events from merges that were replaced are ignored, and cancelled
+        merges leave the mods uncolored."""
+        job = self.merge_job
+        if job is None or not job.done():
+            return
+        if job.cancelled():
+            self.merge_text.set('')
+            return
+        # pylint:disable=broad-except
+        try:
+            result = job.result()
+        except Exception:
+            self.merge_text.set('Merge failed; see the log for details')
+            return
         colors = ['pale green', 'yellow', 'orange', 'red', 'white']
-        result = mods.merge_all_mods(self.installed)
         for i, status in enumerate(result):
             self.installed_list.itemconfig(i, bg=colors[status])
         self.status = max(result + [0])
+        self.merge_text.set('')
 
     def install_mods(self):
         """Replaces <df>/raw with the contents LNP/Baselines/temp/raw"""
+        if self.merge_job is not None and not self.merge_job.done():
+            messagebox.showinfo(
+                'Mods not ready',
+                'The selected mods are still being merged.\n\n'
+                'Try again when the merge has finished.')
+            return
         if messagebox.askokcancel(
                 message=('Your raws will be changed.\n\n'
                          'The mod merging function is still in beta.  This '
@@ -230,6 +298,7 @@ class ModsTab(Tab):
         """Simplify mods; runs on startup if called directly by button."""
         if not tkhelpers.check_vanilla_raws():
             return
+        mergejob.cancel_merge_job()
         m, f = mods.simplify_mods()
         messagebox.showinfo(
             str(m) + ' mods simplified',